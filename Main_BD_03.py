@@ -10,11 +10,13 @@ from torch.autograd import Variable
 from imageio import imread, imsave
 from torch.nn import functional as F
 from torch.nn import init
-from skimage.morphology import label
 import matplotlib.pyplot as plt
 import sys
 import os
-import pickle
+from tensor_store import load_store
+from unet import UNet
+from rle import prob_to_rles
+from losses import WeightedBCELoss
 import time
 
 output = sys.argv[1]
@@ -27,185 +29,15 @@ if not os.path.exists('../' + output):
 
 # Use cuda or not
 USE_CUDA = 1
+# Checkpoint the UNet's down/up blocks (unet.py) so whole images train in a fraction of the activation memory, at
+# the cost of recomputing each block in the backward pass
+CHECKPOINT = 0
+
+# Per-pixel loss weighting (scheme, parameter) of losses.py; its weight maps are cached by dataloader()
+WEIGHTING = ('clip', 60)
 
 def dataloader(handles, mode = 'train'):
-    try:
-        with open('../inputs/mirror_roll/' + mode + '.pickle', 'rb') as f:
-            images = pickle.load(f)
-    except:
-        images = {}
-        images['Image'] = []
-        images['Label'] = []
-        images['ID'] = []
-        images['Dim'] = []
-        for idx, row in handles.iterrows():
-            im = imread(row['Image'])
-            im = im / im.max() * 255
-            im_aug = []
-            shape = im.shape[0]
-            if mode == 'train':
-                ima = np.rot90(im)
-                imb = np.rot90(ima)
-                imc = np.rot90(imb)
-                imd = np.fliplr(im)
-                ime = np.flipud(im)
-            image = np.empty((3, shape, shape), dtype='float32')
-            for i in range(3):
-                image[i,:,:] = im[:,:,i]
-            im = image
-            im_aug.append(im)
-            if mode == 'train':
-                for i in range(3):
-                    image[i, :, :] = ima[:, :, i]
-                ima = image
-                for i in range(3):
-                    image[i, :, :] = imb[:, :, i]
-                imb = image
-                for i in range(3):
-                    image[i, :, :] = imc[:, :, i]
-                imc = image
-                for i in range(3):
-                    image[i, :, :] = imd[:, :, i]
-                imd = image
-                for i in range(3):
-                    image[i, :, :] = ime[:, :, i]
-                ime = image
-                im_aug.append(ima)
-                im_aug.append(imb)
-                im_aug.append(imc)
-                im_aug.append(imd)
-                im_aug.append(ime)
-            images['Image'].append(np.array(im_aug))
-
-            if mode != 'test':
-                la_aug = []
-                la = imread(row['Label'])
-                if mode == 'train':
-                    laa = np.rot90(la)
-                    lab = np.rot90(laa)
-                    lac = np.rot90(lab)
-                    lad = np.fliplr(la)
-                    lae = np.flipud(la)
-                la = np.reshape(la, [1, la.shape[0], la.shape[1]])
-                la_aug.append(la)
-                if mode == 'train':
-                    laa = np.reshape(laa, [1, laa.shape[0], laa.shape[1]])
-                    lab = np.reshape(lab, [1, lab.shape[0], lab.shape[1]])
-                    lac = np.reshape(lac, [1, lac.shape[0], lac.shape[1]])
-                    lad = np.reshape(lad, [1, lad.shape[0], lad.shape[1]])
-                    lae = np.reshape(lae, [1, lae.shape[0], lae.shape[1]])
-                    la_aug.append(laa)
-                    la_aug.append(lab)
-                    la_aug.append(lac)
-                    la_aug.append(lad)
-                    la_aug.append(lae)
-                images['Label'].append(np.array(la_aug))
-
-            elif mode == 'test':
-                images['Dim'].append([(row['Width'], row['Height'])])
-            images['ID'].append(row['ID'])
-
-        with open("../inputs/mirror_roll/" + mode + '.pickle', 'wb') as f:
-            pickle.dump(images, f)
-        with open('../inputs/mirror_roll/' + mode + '.pickle', 'rb') as f:
-            images = pickle.load(f)
-    return images
-
-
-class UNet_down_block(torch.nn.Module):
-    def __init__(self, input_channel, output_channel, down_size):
-        super(UNet_down_block, self).__init__()
-        self.conv1 = torch.nn.Conv2d(input_channel, output_channel, 3, padding=1)
-        self.bn1 = torch.nn.BatchNorm2d(output_channel)
-        self.conv2 = torch.nn.Conv2d(output_channel, output_channel, 3, padding=1)
-        self.bn2 = torch.nn.BatchNorm2d(output_channel)
-        self.conv3 = torch.nn.Conv2d(output_channel, output_channel, 3, padding=1)
-        self.bn3 = torch.nn.BatchNorm2d(output_channel)
-        self.max_pool = torch.nn.MaxPool2d(2, 2)
-        self.relu = torch.nn.ReLU()
-        self.down_size = down_size
-
-    def forward(self, x):
-        if self.down_size:
-            x = self.max_pool(x)
-        x = self.relu(self.bn1(self.conv1(x)))
-        x = self.relu(self.bn2(self.conv2(x)))
-        x = self.relu(self.bn3(self.conv3(x)))
-        return x
-
-
-class UNet_up_block(torch.nn.Module):
-    def __init__(self, prev_channel, input_channel, output_channel):
-        super(UNet_up_block, self).__init__()
-        self.up_sampling = torch.nn.Upsample(scale_factor=2, mode='bilinear')
-        self.conv1 = torch.nn.Conv2d(prev_channel + input_channel, output_channel, 3, padding=1)
-        self.bn1 = torch.nn.BatchNorm2d(output_channel)
-        self.conv2 = torch.nn.Conv2d(output_channel, output_channel, 3, padding=1)
-        self.bn2 = torch.nn.BatchNorm2d(output_channel)
-        self.conv3 = torch.nn.Conv2d(output_channel, output_channel, 3, padding=1)
-        self.bn3 = torch.nn.BatchNorm2d(output_channel)
-        self.relu = torch.nn.ReLU()
-
-    def forward(self, prev_feature_map, x):
-        x = self.up_sampling(x)
-        x = torch.cat((x, prev_feature_map), dim=1)
-        x = self.relu(self.bn1(self.conv1(x)))
-        x = self.relu(self.bn2(self.conv2(x)))
-        x = self.relu(self.bn3(self.conv3(x)))
-        return x
-
-
-class UNet(torch.nn.Module):
-    def __init__(self):
-        super(UNet, self).__init__()
-
-        self.down_block1 = UNet_down_block(3, 16, False)
-        self.down_block2 = UNet_down_block(16, 32, True)
-        self.down_block3 = UNet_down_block(32, 64, True)
-        self.down_block4 = UNet_down_block(64, 128, True)
-        self.down_block5 = UNet_down_block(128, 256, True)
-        self.down_block6 = UNet_down_block(256, 512, True)
-        self.down_block7 = UNet_down_block(512, 1024, True)
-
-        self.mid_conv1 = torch.nn.Conv2d(1024, 1024, 3, padding=1)
-        self.bn1 = torch.nn.BatchNorm2d(1024)
-        self.mid_conv2 = torch.nn.Conv2d(1024, 1024, 3, padding=1)
-        self.bn2 = torch.nn.BatchNorm2d(1024)
-        self.mid_conv3 = torch.nn.Conv2d(1024, 1024, 3, padding=1)
-        self.bn3 = torch.nn.BatchNorm2d(1024)
-
-        self.up_block1 = UNet_up_block(512, 1024, 512)
-        self.up_block2 = UNet_up_block(256, 512, 256)
-        self.up_block3 = UNet_up_block(128, 256, 128)
-        self.up_block4 = UNet_up_block(64, 128, 64)
-        self.up_block5 = UNet_up_block(32, 64, 32)
-        self.up_block6 = UNet_up_block(16, 32, 16)
-
-        self.last_conv1 = torch.nn.Conv2d(16, 16, 3, padding=1)
-        self.last_bn = torch.nn.BatchNorm2d(16)
-        self.last_conv2 = torch.nn.Conv2d(16, 1, 1, padding=0)
-        self.relu = torch.nn.ReLU()
-
-    def forward(self, x):
-        self.x1 = self.down_block1(x)
-        self.x2 = self.down_block2(self.x1)
-        self.x3 = self.down_block3(self.x2)
-        self.x4 = self.down_block4(self.x3)
-        self.x5 = self.down_block5(self.x4)
-        self.x6 = self.down_block6(self.x5)
-        self.x7 = self.down_block7(self.x6)
-        self.x7 = self.relu(self.bn1(self.mid_conv1(self.x7)))
-        self.x7 = self.relu(self.bn2(self.mid_conv2(self.x7)))
-        self.x7 = self.relu(self.bn3(self.mid_conv3(self.x7)))
-        x = self.up_block1(self.x6, self.x7)
-        x = self.up_block2(self.x5, x)
-        x = self.up_block3(self.x4, x)
-        x = self.up_block4(self.x3, x)
-        x = self.up_block5(self.x2, x)
-        x = self.up_block6(self.x1, x)
-        x = self.relu(self.last_bn(self.last_conv1(x)))
-        x = self.last_conv2(x)
-        return x
+    return load_store(handles, mode, '../inputs/mirror_roll/', *WEIGHTING)
 
 
 # Initial weights
@@ -259,23 +91,6 @@ def back_scale(model_im, im_shape):
     return new_im
 
 
-def rle_encoding(x):
-    dots = np.where(x.T.flatten() == 1)[0]
-    run_lengths = []
-    prev = -2
-    for b in dots:
-        if (b > prev + 1): run_lengths.extend((b + 1, 0))
-        run_lengths[-1] += 1
-        prev = b
-    return run_lengths
-
-
-def prob_to_rles(x, cutoff=0.5):
-    lab_img = label(x > cutoff)
-    for i in range(1, lab_img.max() + 1):
-        yield rle_encoding(lab_img == i)
-
-
 def dice_loss(input, target):
     smooth = 1.
     iflat = input.view(-1).cpu()
@@ -298,7 +113,7 @@ def train(bs, sample, vasample, ep, ilr):
     lr_dec = 1
     init_lr = ilr
 
-    model = Cuda(UNet())
+    model = Cuda(UNet(checkpoint=CHECKPOINT))
     init_weights(model)
     opt = torch.optim.Adam(model.parameters(), lr=init_lr)
     opt.zero_grad()
@@ -310,6 +125,9 @@ def train(bs, sample, vasample, ep, ilr):
     vlosslists = []
     # vdicelist = []
 
+    # class-balance weighted BCE; weight maps are precomputed once and cached next to the tensor store
+    loss_fn = WeightedBCELoss(*WEIGHTING)
+
     for epoch in range(ep):
         lr = init_lr * lr_dec
         order = np.arange(rows_trn)
@@ -324,31 +142,15 @@ def train(bs, sample, vasample, ep, ilr):
             # read in a batch
             trim = sample['Image'][rows[0]]
             trla = sample['Label'][rows[0]]
+            trwe = sample['Weight'][rows[0]]
             for iit in range(6):
                 trimm = trim[iit:iit + 1, :, :, :]
                 trlaa = trla[iit:iit + 1, :, :, :]
-                label_ratio = (trlaa>0).sum() / (trlaa.shape[1]*trlaa.shape[2]*trlaa.shape[3] - (trlaa>0).sum())
-                # add_weight = np.ones([1, 1, trlaa.shape[2], trlaa.shape[3]]) * 255 #For no weight only
-                # loss_fn = torch.nn.BCEWithLogitsLoss(weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor))) #For no weight only
-                # print(label_ratio)
-                if label_ratio < 1:
-                    add_weight = (trlaa[0,0,:,:] / 255 + 1 / (1 / label_ratio - 1))
-                    add_weight = np.clip(add_weight / add_weight.max() * 255, 60, None)
-                    loss_fn = torch.nn.BCEWithLogitsLoss(weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                elif label_ratio > 1:
-                    add_weight = (trlaa[0,0,:,:] / 255 + 1 / (label_ratio - 1))
-                    add_weight = np.clip(add_weight / add_weight.max() * 255, 60, None)
-                    loss_fn = torch.nn.BCEWithLogitsLoss(weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                elif label_ratio == 1:
-                    add_weight = np.ones([1,1,trlaa.shape[2], trlaa.shape[3]]) * 255
-                    loss_fn = torch.nn.BCEWithLogitsLoss(weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                # print(add_weight.max(), add_weight.min())
-                ## (1+x)/x = 1/label_ratio
-                ## x = 1/(1/label_ratio - 1)
+                trwee = trwe[iit:iit + 1, :, :, :]
                 x = Cuda(Variable(torch.from_numpy(trimm).type(torch.FloatTensor)))
                 y = Cuda(Variable(torch.from_numpy(trlaa / 255).type(torch.FloatTensor)))
                 pred_mask = model(x) #.cpu()  # .round()
-                loss = loss_fn(pred_mask, y).cpu() + dice_loss(F.sigmoid(pred_mask), y)
+                loss = loss_fn(pred_mask, y, Cuda(torch.from_numpy(trwee))).cpu() + dice_loss(F.sigmoid(pred_mask), y)
                 losslist.append(loss.data.numpy()[0])
                 loss.backward()
                 # dice = 1 - dice_loss(F.sigmoid(pred_mask), y)
@@ -366,29 +168,15 @@ def train(bs, sample, vasample, ep, ilr):
         for itr in range(rows_val):
             vaim = vasample['Image'][itr]
             vala = vasample['Label'][itr]
+            vawe = vasample['Weight'][itr]
             for iit in range(1):
                 vaimm = vaim[iit:iit + 1, :, :, :]
                 valaa = vala[iit:iit + 1, :, :, :]
-                label_ratio = (valaa>0).sum() / (valaa.shape[1]*valaa.shape[2] * valaa.shape[3] - (valaa>0).sum())
-                # add_weight = np.ones([1, 1, valaa.shape[2], valaa.shape[3]]) * 255 #For no weight only
-                # loss_fn = torch.nn.BCEWithLogitsLoss(weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor))) #For no weight only
-                # print(label_ratio)
-                if label_ratio < 1:
-                    add_weight = (valaa[0,0,:,:] / 255 + 1 / (1 / label_ratio - 1))
-                    add_weight = np.clip(add_weight / add_weight.max() * 255, 60, None)
-                    loss_fn = torch.nn.BCEWithLogitsLoss(weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                elif label_ratio > 1:
-                    add_weight = (valaa[0,0,:,:] / 255 + 1 / (label_ratio - 1))
-                    add_weight = np.clip(add_weight / add_weight.max() * 255, 60, None)
-                    loss_fn = torch.nn.BCEWithLogitsLoss(weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                elif label_ratio == 1:
-                    add_weight = np.ones([1,1,valaa.shape[2], valaa.shape[3]]) * 255
-                    loss_fn = torch.nn.BCEWithLogitsLoss(weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                # print(add_weight.max(), add_weight.min())
+                vawee = vawe[iit:iit + 1, :, :, :]
                 xv = Cuda(Variable(torch.from_numpy(vaimm).type(torch.FloatTensor)))
                 yv = Cuda(Variable(torch.from_numpy(valaa / 255).type(torch.FloatTensor)))
                 pred_maskv = model(xv) #.cpu()  # .round()
-                vloss = loss_fn(pred_maskv, yv).cpu() + dice_loss(F.sigmoid(pred_maskv), yv)
+                vloss = loss_fn(pred_maskv, yv, Cuda(torch.from_numpy(vawee))).cpu() + dice_loss(F.sigmoid(pred_maskv), yv)
                 vlosslist.append(vloss.data.numpy()[0])
                 # vdice = 1 - dice_loss(F.sigmoid(pred_maskv), yv)
                 # vdicelist.append(vdice)
@@ -10,11 +10,13 @@ from torch.autograd import Variable
 from imageio import imread, imsave
 from torch.nn import functional as F
 from torch.nn import init
-from skimage.morphology import label
 import matplotlib.pyplot as plt
 import sys
 import os
-import pickle
+from tensor_store import load_store
+from rle import prob_to_rles
+from losses import WeightedBCELoss
+from tiling import tiles, untile
 import torch.random
 
 output = sys.argv[1]
@@ -32,99 +34,11 @@ USE_CUDA = 1
 
 def minicut(im):
     imdim = (im.shape[-2], im.shape[-1])
-    minilist = []
-    num1 = int(im.shape[-2]/256)
-    num2 = int(im.shape[-1]/256)
-    for co in range(num1):
-        for ro in range(num2):
-            mini = im[0,:,co*256:(co+1)*256,ro*256:(ro+1)*256]
-            minilist.append(mini)
-    minilist = np.array(minilist)
-    return minilist, imdim
+    return tiles(im[0]), imdim
 
 
 def dataloader(handles, mode = 'train'):
-    try:
-        with open('../inputs/cropped/' + mode + '.pickle', 'rb') as f:
-            images = pickle.load(f)
-    except:
-        images = {}
-        images['Image'] = []
-        images['Label'] = []
-        images['ID'] = []
-        images['Dim'] = []
-        for idx, row in handles.iterrows():
-            im = imread(row['Image'])
-            im = im / im.max() * 255
-            im_aug = []
-            shape = im.shape[0]
-            if mode == 'train':
-                ima = np.rot90(im)
-                imb = np.rot90(ima)
-                imc = np.rot90(imb)
-                imd = np.fliplr(im)
-                ime = np.flipud(im)
-            image = np.empty((3, shape, shape), dtype='float32')
-            for i in range(3):
-                image[i,:,:] = im[:,:,i]
-            im = image
-            im_aug.append(im)
-            if mode == 'train':
-                for i in range(3):
-                    image[i, :, :] = ima[:, :, i]
-                ima = image
-                for i in range(3):
-                    image[i, :, :] = imb[:, :, i]
-                imb = image
-                for i in range(3):
-                    image[i, :, :] = imc[:, :, i]
-                imc = image
-                for i in range(3):
-                    image[i, :, :] = imd[:, :, i]
-                imd = image
-                for i in range(3):
-                    image[i, :, :] = ime[:, :, i]
-                ime = image
-                im_aug.append(ima)
-                im_aug.append(imb)
-                im_aug.append(imc)
-                im_aug.append(imd)
-                im_aug.append(ime)
-            images['Image'].append(np.array(im_aug))
-
-            if mode != 'test':
-                la_aug = []
-                la = imread(row['Label'])
-                if mode == 'train':
-                    laa = np.rot90(la)
-                    lab = np.rot90(laa)
-                    lac = np.rot90(lab)
-                    lad = np.fliplr(la)
-                    lae = np.flipud(la)
-                la = np.reshape(la, [1, la.shape[0], la.shape[1]])
-                la_aug.append(la)
-                if mode == 'train':
-                    laa = np.reshape(laa, [1, laa.shape[0], laa.shape[1]])
-                    lab = np.reshape(lab, [1, lab.shape[0], lab.shape[1]])
-                    lac = np.reshape(lac, [1, lac.shape[0], lac.shape[1]])
-                    lad = np.reshape(lad, [1, lad.shape[0], lad.shape[1]])
-                    lae = np.reshape(lae, [1, lae.shape[0], lae.shape[1]])
-                    la_aug.append(laa)
-                    la_aug.append(lab)
-                    la_aug.append(lac)
-                    la_aug.append(lad)
-                    la_aug.append(lae)
-                images['Label'].append(np.array(la_aug))
-
-            elif mode == 'test':
-                images['Dim'].append([(row['Width'], row['Height'])])
-            images['ID'].append(row['ID'])
-
-        with open("../inputs/cropped/" + mode + '.pickle', 'wb') as f:
-            pickle.dump(images, f)
-        with open('../inputs/cropped/' + mode + '.pickle', 'rb') as f:
-            images = pickle.load(f)
-    return images
+    return load_store(handles, mode, '../inputs/cropped/')
 
 # def reader(list, mode='va'):
 #     labellist = []
@@ -324,23 +238,6 @@ def back_scale(model_im, im_shape):
     return new_im
 
 
-def rle_encoding(x):
-    dots = np.where(x.T.flatten() == 1)[0]
-    run_lengths = []
-    prev = -2
-    for b in dots:
-        if (b > prev + 1): run_lengths.extend((b + 1, 0))
-        run_lengths[-1] += 1
-        prev = b
-    return run_lengths
-
-
-def prob_to_rles(x, cutoff=0.5):
-    lab_img = label(x > cutoff)
-    for i in range(1, lab_img.max() + 1):
-        yield rle_encoding(lab_img == i)
-
-
 def metric(y_pred, target):
     pred_vec = y_pred.view(-1).data.numpy()
     target_vec = target.view(-1).data.numpy()
@@ -365,6 +262,9 @@ def train(bs, sample, vasample, ep, ilr, lr_dec):
     losslists = []
     vlosslists = []
 
+    # class-balance weighted BCE; weight maps are computed from each label on its own device (losses.py)
+    loss_fn = WeightedBCELoss('linear')
+
     for epoch in range(ep):
         lr = init_lr * (0.1 ** (epoch // lr_dec))
         order = np.arange(rows_trn)
@@ -388,18 +288,6 @@ def train(bs, sample, vasample, ep, ilr, lr_dec):
                 for iiit in range(minitrlist.shape[0]):
                     xxx = minitrlist[iiit:iiit + 1, :, :, :]
                     yyy = minilalist[iiit:iiit + 1, :, :, :]
-                    label_ratio = (yyy > 0).sum() / (
-                                yyy.shape[1] * yyy.shape[2] * yyy.shape[3] - (yyy > 0).sum())
-                    if label_ratio < 1 and label_ratio > 0:
-                        add_weight = (yyy[0, 0, :, :] / 255 + 1 / (1 / label_ratio - 1)) * 100
-                        loss_fn = torch.nn.BCEWithLogitsLoss(
-                            weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                    elif label_ratio > 1:
-                        add_weight = (yyy[0, 0, :, :] / 255 + 1 / (label_ratio - 1)) * 100
-                        loss_fn = torch.nn.BCEWithLogitsLoss(
-                            weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                    elif label_ratio == 1 or label_ratio == 0:
-                        loss_fn = torch.nn.BCEWithLogitsLoss()
 
                     x = Cuda(Variable(torch.from_numpy(xxx).type(torch.FloatTensor)))
                     yyy= Cuda(Variable(torch.from_numpy(yyy/255).type(torch.FloatTensor)))
@@ -424,18 +312,6 @@ def train(bs, sample, vasample, ep, ilr, lr_dec):
                 for iiit in range(minivalist.shape[0]):
                     xxx = minivalist[iiit:iiit + 1, :, :, :]
                     yyy = vminilalist[iiit:iiit + 1, :, :, :]
-                    label_ratio = (yyy > 0).sum() / (
-                                yyy.shape[1] * yyy.shape[2] * yyy.shape[3] - (yyy > 0).sum())
-                    if label_ratio < 1 and label_ratio > 0:
-                        add_weight = (yyy[0, 0, :, :] / 255 + 1 / (1 / label_ratio - 1)) * 100
-                        loss_fn = torch.nn.BCEWithLogitsLoss(
-                            weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                    elif label_ratio > 1:
-                        add_weight = (yyy[0, 0, :, :] / 255 + 1 / (label_ratio - 1)) * 100
-                        loss_fn = torch.nn.BCEWithLogitsLoss(
-                            weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                    elif label_ratio == 1 or label_ratio == 0:
-                        loss_fn = torch.nn.BCEWithLogitsLoss()
                     x = Cuda(Variable(torch.from_numpy(xxx).type(torch.FloatTensor)))
                     yyy= Cuda(Variable(torch.from_numpy(yyy/255).type(torch.FloatTensor)))
                     pred_maskv = model(x) # .cpu() # .round()
@@ -510,11 +386,7 @@ def test(tesample, model, group):
             pred_mask_list.append(pred_mask)
         num1 = int(teimmdim[0] / 256)
         num2 = int(teimmdim[1] / 256)
-        a = 0
-        for co in range(num1):
-            for ro in range(num2):
-                full_pred_maskt[:, :, co * 256:(co + 1) * 256, ro * 256:(ro + 1) * 256] = pred_mask_list[a]
-                a += 1
+        untile(np.concatenate(pred_mask_list), num1, num2, out=full_pred_maskt[0])
         # pred_mask = pred_mask(pred_mask > 0.5).type(torch.FloatTensor)
         pred_np = full_pred_maskt.round()
         pred_np = back_scale(pred_np, tedim).astype(np.uint8)
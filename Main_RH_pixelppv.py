@@ -12,6 +12,7 @@ from skimage.morphology import label
 import matplotlib.pyplot as plt
 import sys
 import os
+from tiling import tiles, untile
 
 
 # Use cuda or not
@@ -196,28 +197,12 @@ def reader (list, mode='va'):
 
 
 def minicut(im):
-    imdim = (im.shape[1], im.shape[2])
-    minilist = []
-    num1 = int(im.shape[1]/256)
-    num2 = int(im.shape[2]/256)
-    for co in range(num1):
-        for ro in range(num2):
-            mini = im[:,co*256:(co+1)*256,ro*256:(ro+1)*256]
-            minilist.append(mini)
-    minilist = np.array(minilist)
-    return minilist, imdim
+    imdim = (im.shape[-2], im.shape[-1])
+    return tiles(im), imdim
 
 def minicutraw(im):
     imdim = (im.shape[0], im.shape[1])
-    minilist = []
-    num1 = int(im.shape[0]/256)
-    num2 = int(im.shape[1]/256)
-    for co in range(num1):
-        for ro in range(num2):
-            mini = im[co*256:(co+1)*256,ro*256:(ro+1)*256,:]
-            minilist.append(mini)
-    minilist = np.array(minilist)
-    return minilist, imdim
+    return np.moveaxis(tiles(np.moveaxis(im, -1, 0)), 1, -1), imdim
 
 #
 # def reader (list):
@@ -364,11 +349,7 @@ def train(bs, sample, vasample, ep, ilr, lr_dec):
                     pred_mask_list.append(pred_mask)
                 num1 = int(trimmdim[0] / 256)
                 num2 = int(trimmdim[1] / 256)
-                a = 0
-                for co in range(num1):
-                    for ro in range(num2):
-                        full_pred_mask[:,:,co * 256:(co + 1) * 256, ro * 256:(ro + 1) * 256] = pred_mask_list[a]
-                        a += 1
+                untile(np.concatenate(pred_mask_list), num1, num2, out=full_pred_mask[0])
                 if USE_CUDA:
                     full_pred_mask = Cuda(Variable(torch.from_numpy(full_pred_mask).type(torch.FloatTensor)))
                 else:
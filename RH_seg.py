@@ -6,248 +6,82 @@ import pandas as pd  # data processing, CSV file I/O (e.g. pd.read_csv)
 
 np.random.seed(1234)
 import torch
-from torch.autograd import Variable
-from imageio import imread, imsave
+from imageio import imsave
 from torch.nn import functional as F
 from torch.nn import init
-from skimage.morphology import label
 import matplotlib.pyplot as plt
 import sys
 import os
-import pickle
+from tensor_store import load_store
+from rle import prob_to_rles
+from losses import WeightedBCELoss
+from nuclei_data import NucleiDataset, make_loader, tile_batches, to_device
+from inference import predict_images, unpad
+from unet import UNet
+from precision import autocast, make_scaler
+from dihedral import IDENTITY
+from tta import DihedralTTA
+from submission import SubmissionWriter
 import torch.random
+import time
 
 # ouputs number; epochs; initial learning rate; learning rate decay pace
 output = sys.argv[1]
 eps = sys.argv[2]
 LR = sys.argv[3]
 lr_decay = sys.argv[4]
+# optional: tiles per batch; batches per optimizer step (0 = one step per epoch). Defaults keep the original 1 and 0
+batch_size = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+accum_steps = int(sys.argv[6]) if len(sys.argv) > 6 else 0
 
 if not os.path.exists('../' + output):
     os.makedirs('../' + output)
 
 # Use cuda or not (use GPU or CPU)
 USE_CUDA = 1
-
-
-# Image cutter (cut to 256x256); input an image, return an array of cutted images and original image dimention
-def minicut(im):
-    imdim = (im.shape[-2], im.shape[-1])
-    minilist = []
-    num1 = int(im.shape[-2]/256)
-    num2 = int(im.shape[-1]/256)
-    for co in range(num1):
-        for ro in range(num2):
-            mini = im[0,:,co*256:(co+1)*256,ro*256:(ro+1)*256]
-            minilist.append(mini)
-    minilist = np.array(minilist)
-    return minilist, imdim
-
-
-# Data loader for training; if we have stored images in a pickle file, just read it; otherwise, we make a pickle.
-# Training images will be augmented by this function, validation and test images won't.
+# UNet architecture (unet.UNet's depth, width, convs and upsample arguments); empty for the original network. Saved in
+# the checkpoints, so deploy.py, quantize.py and run_inference.py rebuild the same architecture
+UNET = dict()
+# Per-pixel loss weighting scheme (one of losses.SCHEMES) and its parameter; weight maps are cached next to the store
+WEIGHTING = ('linear', None)
+# Number of DataLoader worker processes preparing training/validation tiles
+WORKERS = 4
+# Test-time sliding window: tile size, pixels shared by neighbouring tiles, blending window (inference.BLENDS) and
+# tiles per forward pass
+TILE = 256
+OVERLAP = 64
+BLEND = 'cosine'
+TEST_BATCH = 8
+# Forward-pass precision for training and testing, one of precision.PRECISIONS: 'fp32', 'bf16' (CPU or GPU) or
+# 'fp16' (GPU only, with loss scaling)
+PRECISION = 'fp32'
+# Test-time augmentation: dihedral transforms (dihedral.py) whose predictions are averaged, (IDENTITY,) for none, and the
+# mean uncertainty above which a tile gets the transforms after the first (None: every tile gets all of them)
+TTA_TRANSFORMS = (IDENTITY,)
+TTA_THRESHOLD = None
+DEVICE_TYPE = 'cuda' if USE_CUDA else 'cpu'
+
+
+# Data loader for training; if we have stored images in the memory-mapped store (tensor_store.py), just open it;
+# otherwise, we build the store first.
+# Training images will be augmented lazily (rotations/flips are views made at access time), validation and test images
+# won't.
 # handles is a list made during preprocessing contains all paths to images and original image dimensions.
 # note that these images loaded here have already been padded to shapes of multiples of 256x256 during preprocessing
 def dataloader(handles, mode = 'train'):
-    try:
-        with open('../inputs/cropped/' + mode + '.pickle', 'rb') as f:
-            images = pickle.load(f)
-    except:
-        images = {}
-        images['Image'] = []
-        images['Label'] = []
-        images['ID'] = []
-        images['Dim'] = []
-        # itterate over handles
-        for idx, row in handles.iterrows():
-            # read a image
-            im = imread(row['Image'])
-            # normalize image
-            im = im / im.max() * 255
-            im_aug = []
-            shape = im.shape[0]
-            # training images got augmented
-            if mode == 'train':
-                ima = np.rot90(im)
-                imb = np.rot90(ima)
-                imc = np.rot90(imb)
-                imd = np.fliplr(im)
-                ime = np.flipud(im)
-            # reshape image for conversion to tensor
-            image = np.empty((3, shape, shape), dtype='float32')
-            for i in range(3):
-                image[i,:,:] = im[:,:,i]
-            im = image
-            im_aug.append(im)
-            # reshape for training augmented images
-            if mode == 'train':
-                for i in range(3):
-                    image[i, :, :] = ima[:, :, i]
-                ima = image
-                for i in range(3):
-                    image[i, :, :] = imb[:, :, i]
-                imb = image
-                for i in range(3):
-                    image[i, :, :] = imc[:, :, i]
-                imc = image
-                for i in range(3):
-                    image[i, :, :] = imd[:, :, i]
-                imd = image
-                for i in range(3):
-                    image[i, :, :] = ime[:, :, i]
-                ime = image
-                im_aug.append(ima)
-                im_aug.append(imb)
-                im_aug.append(imc)
-                im_aug.append(imd)
-                im_aug.append(ime)
-            # save images to a list
-            images['Image'].append(np.array(im_aug))
-
-            # For training and validation images, we should do same thing for labels (ground truth masks)
-            if mode != 'test':
-                la_aug = []
-                la = imread(row['Label'])
-                if mode == 'train':
-                    laa = np.rot90(la)
-                    lab = np.rot90(laa)
-                    lac = np.rot90(lab)
-                    lad = np.fliplr(la)
-                    lae = np.flipud(la)
-                la = np.reshape(la, [1, la.shape[0], la.shape[1]])
-                la_aug.append(la)
-                if mode == 'train':
-                    laa = np.reshape(laa, [1, laa.shape[0], laa.shape[1]])
-                    lab = np.reshape(lab, [1, lab.shape[0], lab.shape[1]])
-                    lac = np.reshape(lac, [1, lac.shape[0], lac.shape[1]])
-                    lad = np.reshape(lad, [1, lad.shape[0], lad.shape[1]])
-                    lae = np.reshape(lae, [1, lae.shape[0], lae.shape[1]])
-                    la_aug.append(laa)
-                    la_aug.append(lab)
-                    la_aug.append(lac)
-                    la_aug.append(lad)
-                    la_aug.append(lae)
-                images['Label'].append(np.array(la_aug))
-
-            # Save original dimension of test images
-            elif mode == 'test':
-                images['Dim'].append([(row['Width'], row['Height'])])
-            images['ID'].append(row['ID'])
-        # save all things to a pickle file and loaded it to return
-        with open("../inputs/cropped/" + mode + '.pickle', 'wb') as f:
-            pickle.dump(images, f)
-        with open('../inputs/cropped/' + mode + '.pickle', 'rb') as f:
-            images = pickle.load(f)
-    return images
-
-## Main U-net model
-# Down sampling phase layers
-class UNet_down_block(torch.nn.Module):
-    def __init__(self, input_channel, output_channel, down_size):
-        super(UNet_down_block, self).__init__()
-        self.conv1 = torch.nn.Conv2d(input_channel, output_channel, 3, padding=1)
-        self.bn1 = torch.nn.BatchNorm2d(output_channel)
-        self.conv2 = torch.nn.Conv2d(output_channel, output_channel, 3, padding=1)
-        self.bn2 = torch.nn.BatchNorm2d(output_channel)
-        self.conv3 = torch.nn.Conv2d(output_channel, output_channel, 3, padding=1)
-        self.bn3 = torch.nn.BatchNorm2d(output_channel)
-        self.max_pool = torch.nn.MaxPool2d(2, 2)
-        self.relu = torch.nn.ReLU()
-        self.down_size = down_size
-
-    def forward(self, x):
-        if self.down_size:
-            x = self.max_pool(x)
-        x = self.relu(self.bn1(self.conv1(x)))
-        x = self.relu(self.bn2(self.conv2(x)))
-        x = self.relu(self.bn3(self.conv3(x)))
-        return x
-
-# Up sampling phase layers
-class UNet_up_block(torch.nn.Module):
-    def __init__(self, prev_channel, input_channel, output_channel):
-        super(UNet_up_block, self).__init__()
-        self.up_sampling = torch.nn.Upsample(scale_factor=2, mode='bilinear')
-        self.conv1 = torch.nn.Conv2d(prev_channel + input_channel, output_channel, 3, padding=1)
-        self.bn1 = torch.nn.BatchNorm2d(output_channel)
-        self.conv2 = torch.nn.Conv2d(output_channel, output_channel, 3, padding=1)
-        self.bn2 = torch.nn.BatchNorm2d(output_channel)
-        self.conv3 = torch.nn.Conv2d(output_channel, output_channel, 3, padding=1)
-        self.bn3 = torch.nn.BatchNorm2d(output_channel)
-        self.relu = torch.nn.ReLU()
-
-    def forward(self, prev_feature_map, x):
-        x = self.up_sampling(x)
-        x = torch.cat((x, prev_feature_map), dim=1)
-        x = self.relu(self.bn1(self.conv1(x)))
-        x = self.relu(self.bn2(self.conv2(x)))
-        x = self.relu(self.bn3(self.conv3(x)))
-        return x
-
-# Put them together and build the model to use
-class UNet(torch.nn.Module):
-    def __init__(self):
-        super(UNet, self).__init__()
-
-        self.down_block1 = UNet_down_block(3, 16, False)
-        self.down_block2 = UNet_down_block(16, 32, True)
-        self.down_block3 = UNet_down_block(32, 64, True)
-        self.down_block4 = UNet_down_block(64, 128, True)
-        self.down_block5 = UNet_down_block(128, 256, True)
-        self.down_block6 = UNet_down_block(256, 512, True)
-        self.down_block7 = UNet_down_block(512, 1024, True)
-
-        self.mid_conv1 = torch.nn.Conv2d(1024, 1024, 3, padding=1)
-        self.bn1 = torch.nn.BatchNorm2d(1024)
-        self.mid_conv2 = torch.nn.Conv2d(1024, 1024, 3, padding=1)
-        self.bn2 = torch.nn.BatchNorm2d(1024)
-        self.mid_conv3 = torch.nn.Conv2d(1024, 1024, 3, padding=1)
-        self.bn3 = torch.nn.BatchNorm2d(1024)
-
-        self.up_block1 = UNet_up_block(512, 1024, 512)
-        self.up_block2 = UNet_up_block(256, 512, 256)
-        self.up_block3 = UNet_up_block(128, 256, 128)
-        self.up_block4 = UNet_up_block(64, 128, 64)
-        self.up_block5 = UNet_up_block(32, 64, 32)
-        self.up_block6 = UNet_up_block(16, 32, 16)
-
-        self.last_conv1 = torch.nn.Conv2d(16, 16, 3, padding=1)
-        self.last_bn = torch.nn.BatchNorm2d(16)
-        self.last_conv2 = torch.nn.Conv2d(16, 1, 1, padding=0)
-        self.relu = torch.nn.ReLU()
-
-    def forward(self, x):
-        self.x1 = self.down_block1(x)
-        self.x2 = self.down_block2(self.x1)
-        self.x3 = self.down_block3(self.x2)
-        self.x4 = self.down_block4(self.x3)
-        self.x5 = self.down_block5(self.x4)
-        self.x6 = self.down_block6(self.x5)
-        self.x7 = self.down_block7(self.x6)
-        self.x7 = self.relu(self.bn1(self.mid_conv1(self.x7)))
-        self.x7 = self.relu(self.bn2(self.mid_conv2(self.x7)))
-        self.x7 = self.relu(self.bn3(self.mid_conv3(self.x7)))
-        x = self.up_block1(self.x6, self.x7)
-        x = self.up_block2(self.x5, x)
-        x = self.up_block3(self.x4, x)
-        x = self.up_block4(self.x3, x)
-        x = self.up_block5(self.x2, x)
-        x = self.up_block6(self.x1, x)
-        x = self.relu(self.last_bn(self.last_conv1(x)))
-        x = self.last_conv2(x)
-        return x
-
+    return load_store(handles, mode, '../inputs/cropped/', *WEIGHTING, tile=256)
 
 # Initial weights for the model
+# (in place, in the parameters' own dtype and device)
 def init_weights(module):
     for name, param in module.named_parameters():
         if name.find('weight') != -1:
             if len(param.size()) == 1:
-                Cuda(init.uniform(param.data, 1).type(torch.DoubleTensor))
+                init.uniform_(param.data, 1)
             else:
-                Cuda(init.xavier_uniform(param.data).type(torch.DoubleTensor))
+                init.xavier_uniform_(param.data)
         elif name.find('bias') != -1:
-            Cuda(init.constant(param.data, 0).type(torch.DoubleTensor))
+            init.constant_(param.data, 0)
 
 
 # Convert variables to GPU compatible version function (ignore the red-line error because I assume your computer don't
@@ -264,40 +98,6 @@ def Cuda(obj):
 
 
 
-# Convert the test image output masks back to its original dimension after the U-net model
-def back_scale(model_im, im_shape):
-    temp = np.reshape(model_im, [model_im.shape[-2], model_im.shape[-1]])
-    row_size_left = (temp.shape[0] - im_shape[0][1]) // 2
-    row_size_right = (temp.shape[0] - im_shape[0][1]) // 2 + (temp.shape[0] - im_shape[0][1]) % 2
-    col_size_left = (temp.shape[1] - im_shape[0][0]) // 2
-    col_size_right = (temp.shape[1] - im_shape[0][0]) // 2 + (temp.shape[1] - im_shape[0][0]) % 2
-    if row_size_right == 0 and col_size_right == 0:
-        new_im = temp[row_size_left:, col_size_left:]
-    elif row_size_right == 0:
-        new_im = temp[row_size_left:, col_size_left:-col_size_right]
-    elif col_size_right == 0:
-        new_im = temp[row_size_left:-row_size_right, col_size_left:]
-    else:
-        new_im = temp[row_size_left:-row_size_right, col_size_left:-col_size_right]
-    return new_im
-
-# For contest csv conversion only
-def rle_encoding(x):
-    dots = np.where(x.T.flatten() == 1)[0]
-    run_lengths = []
-    prev = -2
-    for b in dots:
-        if (b > prev + 1): run_lengths.extend((b + 1, 0))
-        run_lengths[-1] += 1
-        prev = b
-    return run_lengths
-
-# For contest csv conversion only
-def prob_to_rles(x, cutoff=0.5):
-    lab_img = label(x > cutoff)
-    for i in range(1, lab_img.max() + 1):
-        yield rle_encoding(lab_img == i)
-
 # For contest evaluation only
 def metric(y_pred, target):
     pred_vec = y_pred.view(-1).data.numpy()
@@ -309,118 +109,94 @@ def metric(y_pred, target):
     ppv = (tp + 1) / (predicted + label - tp + 1)
     return ppv
 
+# Same score as metric(), for every tile of a batch at once
+def batch_metric(y_pred, target):
+    pred = (y_pred.view(y_pred.shape[0], -1) > 0.5).type(torch.FloatTensor)
+    target_vec = target.view(target.shape[0], -1).type(torch.FloatTensor)
+    label = target_vec.sum(1)
+    tp = (pred * target_vec).sum(1)
+    predicted = pred.sum(1)
+    ppv = (tp + 1) / (predicted + label - tp + 1)
+    return list(ppv.numpy())
+
 ## Main training function
-# bs is batch size, which is 1 in our case
-# sample and vasample are lists containing paths to padded training and validation images and their original dimensions
+# bs is batch size in 256x256 tiles: tiles of consecutive augmented images are stacked into bs x 3 x 256 x 256 batches
+# accum is the number of batches whose gradients are accumulated before each optimizer step; 0 accumulates the whole
+# epoch into a single step, which together with bs=1 reproduces the original one-tile-at-a-time training
+# trloader and valoader are DataLoaders over NucleiDataset (nuclei_data.py); every batch holds the 256x256 tiles,
+# and labels of augmented training (or validation) images, prepared by the loader's worker processes
 # ep is training epoch number
-def train(bs, sample, vasample, ep, ilr, lr_dec):
+def train(bs, trloader, valoader, ep, ilr, lr_dec, accum=0):
     # initial learning rate
     init_lr = ilr
     # Load u-net model
-    model = Cuda(UNet())
+    model = Cuda(UNet(**UNET))
     # initial model weights
     init_weights(model)
     # set up optimizer (use Adam optimizer)
     opt = torch.optim.Adam(model.parameters(), lr=init_lr)
     opt.zero_grad()
-    # Get numbers of training and validation samples
-    rows_trn = len(sample['Label'])
-    rows_val = len(vasample['Label'])
-    # batch per epoch
-    batches_per_epoch = rows_trn // bs
+    # class-balance weighted BCE; weight maps come from the tensor store's cache (computed on the device otherwise)
+    loss_fn = WeightedBCELoss(*WEIGHTING)
+    # loss scaling for fp16 (a pass-through otherwise)
+    scaler = make_scaler(PRECISION, DEVICE_TYPE)
     losslists = []
     vlosslists = []
 
     for epoch in range(ep):
         # Learning rate determination based on learning rate decay pace
         lr = init_lr * (0.1 ** (epoch // lr_dec))
-        order = np.arange(rows_trn)
         losslist = []
         tr_metric_list = []
         va_metric_list = []
-        for itr in range(batches_per_epoch):
-            # load a batch of images (1 image per batch in our case)
-            rows = order[itr * bs: (itr + 1) * bs]
-            if itr + 1 == batches_per_epoch:
-                rows = order[itr * bs:]
-            # read in a batch
-            trim = sample['Image'][rows[0]]
-            trla = sample['Label'][rows[0]]
-            # load augmented and original image of this batch (6 images in our case)
-            for iit in range(6):
-                trimm = trim[iit:iit + 1, :, :, :]
-                trlaa = trla[iit:iit + 1, :, :, :]
-                # cut images to 256x256 small images
-                minitrlist, trimmdim = minicut(trimm)
-                minilalist, trlaadim = minicut(trlaa)
-                # load each 256x256 small image
-                for iiit in range(minitrlist.shape[0]):
-                    xxx = minitrlist[iiit:iiit + 1, :, :, :]
-                    yyy = minilalist[iiit:iiit + 1, :, :, :]
-                    # Get positive/negative ratio in that image, 1 means balanced, 0 means no positive in that image.
-                    label_ratio = (yyy > 0).sum() / (
-                                yyy.shape[1] * yyy.shape[2] * yyy.shape[3] - (yyy > 0).sum())
-                    # adjust weights based on the ratio
-                    if label_ratio < 1 and label_ratio > 0:
-                        add_weight = (yyy[0, 0, :, :] / 255 + 1 / (1 / label_ratio - 1)) * 100
-                        loss_fn = torch.nn.BCEWithLogitsLoss(
-                            weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                    elif label_ratio > 1:
-                        add_weight = (yyy[0, 0, :, :] / 255 + 1 / (label_ratio - 1)) * 100
-                        loss_fn = torch.nn.BCEWithLogitsLoss(
-                            weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                    elif label_ratio == 1 or label_ratio == 0:
-                        loss_fn = torch.nn.BCEWithLogitsLoss()
-                    # Load image to GPU
-                    x = Cuda(Variable(torch.from_numpy(xxx).type(torch.FloatTensor)))
-                    # Load label to GPU
-                    yyy= Cuda(Variable(torch.from_numpy(yyy/255).type(torch.FloatTensor)))
-                    # Predict using u-net
-                    pred_mask = model(x)
-                    # Calculate loss of prediction
-                    loss = loss_fn(pred_mask, yyy)
-                    # save loss
-                    losslist.append(loss.cpu().data.numpy()[0])
-                    loss.backward()
-                    # (For contest only)
-                    tr_metric = metric(F.sigmoid(pred_mask.cpu()), yyy.cpu())
-                    tr_metric_list.append(tr_metric)
-
+        tiles = 0
+        # whether gradients have been accumulated since the last optimizer step
+        pending = False
+        start = time.time()
+        for itr, batch in enumerate(tile_batches(trloader, bs)):
+            # Load tiles, labels and weights to GPU (asynchronously from pinned memory)
+            batch = to_device(batch, USE_CUDA)
+            # Predict using u-net (at PRECISION)
+            with autocast(PRECISION, DEVICE_TYPE):
+                pred_mask = model(batch['image'])
+            # Calculate loss of prediction in float32, weighted per pixel by positive/negative balance of each tile
+            pred_mask = pred_mask.float()
+            loss = loss_fn(pred_mask, batch['label'], batch.get('weight'))
+            # save loss
+            losslist.append(loss.item())
+            if accum:
+                scaler.scale(loss / accum).backward()
+                # optimize model every accum batches
+                pending = (itr + 1) % accum != 0
+                if not pending:
+                    scaler.step(opt)
+                    scaler.update()
+                    opt.zero_grad()
+            else:
+                scaler.scale(loss).backward()
+                pending = True
+            # (For contest only)
+            tr_metric_list.extend(batch_metric(F.sigmoid(pred_mask.detach().cpu()), batch['label'].cpu()))
+            tiles += batch['image'].shape[0]
+        # optimize model based on what is left over from this epoch (everything, if accum is 0); GradScaler.step fails
+        # without a backward pass since the last step
+        if pending:
+            scaler.step(opt)
+            scaler.update()
+            opt.zero_grad()
+        throughput = tiles / (time.time() - start)
 
         vlosslist = []
-        # Do the same thing for validation set
-        for itr in range(rows_val):
-            vaim = vasample['Image'][itr]
-            vala = vasample['Label'][itr]
-            for iit in range(1):
-                vaimm = vaim[iit:iit + 1, :, :, :]
-                valaa = vala[iit:iit + 1, :, :, :]
-
-                minivalist, vaimmdim = minicut(vaimm)
-                vminilalist, valaadim = minicut(valaa)
-                for iiit in range(minivalist.shape[0]):
-                    xxx = minivalist[iiit:iiit + 1, :, :, :]
-                    yyy = vminilalist[iiit:iiit + 1, :, :, :]
-                    label_ratio = (yyy > 0).sum() / (
-                                yyy.shape[1] * yyy.shape[2] * yyy.shape[3] - (yyy > 0).sum())
-                    if label_ratio < 1 and label_ratio > 0:
-                        add_weight = (yyy[0, 0, :, :] / 255 + 1 / (1 / label_ratio - 1)) * 100
-                        loss_fn = torch.nn.BCEWithLogitsLoss(
-                            weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                    elif label_ratio > 1:
-                        add_weight = (yyy[0, 0, :, :] / 255 + 1 / (label_ratio - 1)) * 100
-                        loss_fn = torch.nn.BCEWithLogitsLoss(
-                            weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                    elif label_ratio == 1 or label_ratio == 0:
-                        loss_fn = torch.nn.BCEWithLogitsLoss()
-                    x = Cuda(Variable(torch.from_numpy(xxx).type(torch.FloatTensor)))
-                    yyy= Cuda(Variable(torch.from_numpy(yyy/255).type(torch.FloatTensor)))
-                    pred_maskv = model(x) # .cpu() # .round()
-                    vloss = loss_fn(pred_maskv, yyy)
-                    vlosslist.append(vloss.cpu().data.numpy()[0])
-                    vloss.backward()
-                    va_metric = metric(F.sigmoid(pred_maskv.cpu()), yyy.cpu())
-                    va_metric_list.append(va_metric)
+        # Do the same thing for validation set (no gradients: validation must not leak into the optimizer step)
+        with torch.no_grad():
+            for batch in tile_batches(valoader, bs):
+                batch = to_device(batch, USE_CUDA)
+                with autocast(PRECISION, DEVICE_TYPE):
+                    pred_maskv = model(batch['image']) # .cpu() # .round()
+                pred_maskv = pred_maskv.float()
+                vloss = loss_fn(pred_maskv, batch['label'], batch.get('weight'))
+                vlosslist.append(vloss.item())
+                va_metric_list.extend(batch_metric(F.sigmoid(pred_maskv.cpu()), batch['label'].cpu()))
 
         # Calculate average loss of this epoch
         lossa = np.mean(losslist)
@@ -428,11 +204,8 @@ def train(bs, sample, vasample, ep, ilr, lr_dec):
         tr_score = np.mean(tr_metric_list)
         va_score = np.mean(va_metric_list)
         print(
-            'Epoch {:>3} |lr {:>1.5f} | Loss {:>1.5f} | VLoss {:>1.5f} | Train Score {:>1.5f} | Val Score {:>1.5f} '.format(
-                epoch + 1, lr, lossa, vlossa, tr_score, va_score))
-        # optimize model based on what learned in this epoch
-        opt.step()
-        opt.zero_grad()
+            'Epoch {:>3} |lr {:>1.5f} | Loss {:>1.5f} | VLoss {:>1.5f} | Train Score {:>1.5f} | Val Score {:>1.5f} '
+            '| {:>7.1f} tiles/s'.format(epoch + 1, lr, lossa, vlossa, tr_score, va_score, throughput))
         losslists.append(lossa)
         vlosslists.append(vlossa)
 
@@ -445,6 +218,7 @@ def train(bs, sample, vasample, ep, ilr, lr_dec):
                 'epoch': epoch + 1,
                 'state_dict': model.state_dict(),
                 'optimizer': opt.state_dict(),
+                'unet': model.config,
             }
             torch.save(checkpoint, '../' + output + '/unet-{}'.format(epoch + 1))
 
@@ -470,55 +244,33 @@ def train(bs, sample, vasample, ep, ilr, lr_dec):
 ## Main function for testing
 # tesample is a list containing paths to padded testing images and their original dimensions
 # model is trained model
-def test(tesample, model, group):
-    test_ids = []
-    rles = []
+# the submission csv rows of every image are written to path as soon as it is predicted (submission.py)
+def test(tesample, model, group, path):
     # output folder
     if not os.path.exists('../' + output + '/' + group):
         os.makedirs('../' + output + '/' + group)
 
-    for itr in range(len(tesample['ID'])):
-        # load testing image, ID, and dimension
-        teim = tesample['Image'][itr]
-        teid = tesample['ID'][itr]
-        tedim = tesample['Dim'][itr]
-        # cut image to 256x256 pieces
-        minitelist, teimmdim = minicut(teim)
-        pred_mask_list = []
-        full_pred_maskt = np.zeros((1, 1, teimmdim[0], teimmdim[1]))
-        for iiit in range(minitelist.shape[0]):
-            # load a piece
-            teimmm = minitelist[iiit:iiit + 1, :, :, :]
-            # GPU or not...
-            if USE_CUDA:
-                xt = Cuda(Variable(torch.from_numpy(teimmm).type(torch.FloatTensor)))
-            else:
-                xt = Variable(torch.from_numpy(teimmm).type(torch.FloatTensor))
-            # Predicted mask
-            pred_mask = F.sigmoid(model(xt)).cpu().data.numpy()
-            pred_mask_list.append(pred_mask)
-        # reassemble the masks together for 1 image
-        num1 = int(teimmdim[0] / 256)
-        num2 = int(teimmdim[1] / 256)
-        a = 0
-        for co in range(num1):
-            for ro in range(num2):
-                full_pred_maskt[:, :, co * 256:(co + 1) * 256, ro * 256:(ro + 1) * 256] = pred_mask_list[a]
-                a += 1
-        # Binarize mask for output
-        pred_np = full_pred_maskt.round()
-        pred_np = back_scale(pred_np, tedim).astype(np.uint8)
-        imsave('../' + output + '/' + group + '/' + teid + '_pred.png', pred_np*255)
-        # For contest only
-        rle = list(prob_to_rles(pred_np))
-        rles.extend(rle)
-        test_ids.extend([teid] * len(rle))
-    # For contest only
-    sub = pd.DataFrame()
-    sub['ImageId'] = test_ids
-    sub['EncodedPixels'] = pd.Series(rles).apply(lambda x: ' '.join(str(y) for y in x))
-
-    return sub
+    # original (un-mirrored) regions of the testing images; tiles of consecutive images share forward passes and are
+    # blended back together by inference.py
+    teims = (unpad(tesample['Image'][itr][0], tesample['Dim'][itr]) for itr in range(len(tesample['ID'])))
+    tta = DihedralTTA(TTA_TRANSFORMS, TTA_THRESHOLD) if len(TTA_TRANSFORMS) > 1 else None
+    start = time.time()
+    with SubmissionWriter(path) as sub:
+        for itr, pred_mask in predict_images(model, teims, TILE, OVERLAP, BLEND, TEST_BATCH, PRECISION, tta):
+            teid = tesample['ID'][itr]
+            # Binarize mask for output
+            pred_np = pred_mask.round().astype(np.uint8)
+            imsave('../' + output + '/' + group + '/' + teid + '_pred.png', pred_np*255)
+            # For contest only
+            sub.write(teid, prob_to_rles(pred_np))
+    print('Predicted {} nuclei in {} images in {:.2f} s per image'.format(sub.nuclei, sub.images,
+                                                                       (time.time() - start) / max(1, sub.images)))
+    if tta is not None:
+        # forward time grows with the number of tiles, so the extra orientations' share of it is the added latency
+        per_image = tta.seconds / max(1, sub.images)
+        added = per_image * tta.extra / float(max(1, tta.tiles + tta.extra))
+        print('TTA over {} transforms ran {:.0%} of the extra orientations: {:.2f} s of forward passes per image, '
+              '~{:.2f} s of it added by TTA'.format(len(TTA_TRANSFORMS), tta.coverage(), per_image, added))
 
 ## Main
 # Read csv files containing paths to padded images and their original dimensions
@@ -533,9 +285,11 @@ trsample = dataloader(tr, 'train')
 vasample = dataloader(va, 'val')
 tebsample = dataloader(te, 'test')
 
+# Training and validation tiles are produced by DataLoader worker processes
+trloader = make_loader(NucleiDataset(tr, 'train', trsample), batch_size=1, workers=WORKERS)
+valoader = make_loader(NucleiDataset(va, 'val', vasample), batch_size=1, workers=WORKERS)
+
 # Training
-model = train(1, trsample, vasample, int(eps), float(LR), int(lr_decay))
-# Predict masks for testing set
-tebsub = test(tebsample, model, 'stage_2_test')
-# Contest only csv output
-tebsub.to_csv('../' + output + '/stage_2_test_sub.csv', index=False)
+model = train(batch_size, trloader, valoader, int(eps), float(LR), int(lr_decay), accum_steps)
+# Predict masks for testing set, with the contest only csv output
+test(tebsample, model, 'stage_2_test', '../' + output + '/stage_2_test_sub.csv')
@@ -10,11 +10,13 @@ from torch.autograd import Variable
 from imageio import imread, imsave
 from torch.nn import functional as F
 from torch.nn import init
-from skimage.morphology import label
 import matplotlib.pyplot as plt
 import sys
 import os
-import pickle
+from tensor_store import load_store
+from rle import prob_to_rles
+from losses import WeightedBCELoss
+from tiling import tiles
 import torch.random
 
 # ouputs number; epochs; initial learning rate; learning rate decay pace
@@ -33,112 +35,16 @@ USE_CUDA = 1
 # Image cutter (cut to 256x256); input an image, return an array of cutted images and original image dimention
 def minicut(im):
     imdim = (im.shape[-2], im.shape[-1])
-    minilist = []
-    num1 = int(im.shape[-2] / 256)
-    num2 = int(im.shape[-1] / 256)
-    for co in range(num1):
-        for ro in range(num2):
-            mini = im[0, :, co * 256:(co + 1) * 256, ro * 256:(ro + 1) * 256]
-            minilist.append(mini)
-    minilist = np.array(minilist)
-    return minilist, imdim
-
-
-# Data loader for training; if we have stored images in a pickle file, just read it; otherwise, we make a pickle.
+    return tiles(im[0]), imdim
+
+
+# Data loader for training; if we have stored images in the memory-mapped store (tensor_store.py), just open it;
+# otherwise, we build the store first.
 # Training images will be augmented by this function, validation and test images won't.
 # handles is a list made during preprocessing contains all paths to images and original image dimensions.
 # note that these images loaded here have already been padded to shapes of multiples of 256x256 during preprocessing
 def dataloader(handles, mode='train'):
-    try:
-        with open('../inputs/cropped/' + mode + '.pickle', 'rb') as f:
-            images = pickle.load(f)
-    except:
-        images = {}
-        images['Image'] = []
-        images['Label'] = []
-        images['ID'] = []
-        images['Dim'] = []
-        # itterate over handles
-        for idx, row in handles.iterrows():
-            # read a image
-            im = imread(row['Image'])
-            # normalize image
-            im = im / im.max() * 255
-            im_aug = []
-            shape = im.shape[0]
-            # training images got augmented
-            if mode == 'train':
-                ima = np.rot90(im)
-                imb = np.rot90(ima)
-                imc = np.rot90(imb)
-                imd = np.fliplr(im)
-                ime = np.flipud(im)
-            # reshape image for conversion to tensor
-            image = np.empty((3, shape, shape), dtype='float32')
-            for i in range(3):
-                image[i, :, :] = im[:, :, i]
-            im = image
-            im_aug.append(im)
-            # reshape for training augmented images
-            if mode == 'train':
-                for i in range(3):
-                    image[i, :, :] = ima[:, :, i]
-                ima = image
-                for i in range(3):
-                    image[i, :, :] = imb[:, :, i]
-                imb = image
-                for i in range(3):
-                    image[i, :, :] = imc[:, :, i]
-                imc = image
-                for i in range(3):
-                    image[i, :, :] = imd[:, :, i]
-                imd = image
-                for i in range(3):
-                    image[i, :, :] = ime[:, :, i]
-                ime = image
-                im_aug.append(ima)
-                im_aug.append(imb)
-                im_aug.append(imc)
-                im_aug.append(imd)
-                im_aug.append(ime)
-            # save images to a list
-            images['Image'].append(np.array(im_aug))
-
-            # For training and validation images, we should do same thing for labels (ground truth masks)
-            if mode != 'test':
-                la_aug = []
-                la = imread(row['Label'])
-                if mode == 'train':
-                    laa = np.rot90(la)
-                    lab = np.rot90(laa)
-                    lac = np.rot90(lab)
-                    lad = np.fliplr(la)
-                    lae = np.flipud(la)
-                la = np.reshape(la, [1, la.shape[0], la.shape[1]])
-                la_aug.append(la)
-                if mode == 'train':
-                    laa = np.reshape(laa, [1, laa.shape[0], laa.shape[1]])
-                    lab = np.reshape(lab, [1, lab.shape[0], lab.shape[1]])
-                    lac = np.reshape(lac, [1, lac.shape[0], lac.shape[1]])
-                    lad = np.reshape(lad, [1, lad.shape[0], lad.shape[1]])
-                    lae = np.reshape(lae, [1, lae.shape[0], lae.shape[1]])
-                    la_aug.append(laa)
-                    la_aug.append(lab)
-                    la_aug.append(lac)
-                    la_aug.append(lad)
-                    la_aug.append(lae)
-                images['Label'].append(np.array(la_aug))
-
-            # Save original dimension of test images
-            elif mode == 'test':
-                images['Dim'].append([(row['Width'], row['Height'])])
-            images['ID'].append(row['ID'])
-        # save all things to a pickle file and loaded it to return
-        with open("../inputs/cropped/" + mode + '.pickle', 'wb') as f:
-            pickle.dump(images, f)
-        with open('../inputs/cropped/' + mode + '.pickle', 'rb') as f:
-            images = pickle.load(f)
-    return images
+    return load_store(handles, mode, '../inputs/cropped/')
 
 
 ## Main U-net model
@@ -284,24 +190,6 @@ def back_scale(model_im, im_shape):
     return new_im
 
 
-# For contest csv conversion only
-def rle_encoding(x):
-    dots = np.where(x.T.flatten() == 1)[0]
-    run_lengths = []
-    prev = -2
-    for b in dots:
-        if (b > prev + 1): run_lengths.extend((b + 1, 0))
-        run_lengths[-1] += 1
-        prev = b
-    return run_lengths
-
-
-# For contest csv conversion only
-def prob_to_rles(x, cutoff=0.5):
-    lab_img = label(x > cutoff)
-    for i in range(1, lab_img.max() + 1):
-        yield rle_encoding(lab_img == i)
-
 
 # For contest evaluation only
 def metric(y_pred, target):
@@ -337,6 +225,9 @@ def train(bs, sample, vasample, ep, ilr, lr_dec):
     losslists = []
     vlosslists = []
 
+    # class-balance weighted BCE; weight maps are computed from each label on its own device (losses.py)
+    loss_fn = WeightedBCELoss('linear')
+
     for epoch in range(ep):
         # Learning rate determination based on learning rate decay pace
         lr = init_lr * (0.1 ** (epoch // lr_dec))
@@ -363,20 +254,6 @@ def train(bs, sample, vasample, ep, ilr, lr_dec):
                 for iiit in range(minitrlist.shape[0]):
                     xxx = minitrlist[iiit:iiit + 1, :, :, :]
                     yyy = minilalist[iiit:iiit + 1, :, :, :]
-                    # Get positive/negative ratio in that image, 1 means balanced, 0 means no positive in that image.
-                    label_ratio = (yyy > 0).sum() / (
-                            yyy.shape[1] * yyy.shape[2] * yyy.shape[3] - (yyy > 0).sum())
-                    # adjust weights based on the ratio
-                    if label_ratio < 1 and label_ratio > 0:
-                        add_weight = (yyy[0, 0, :, :] / 255 + 1 / (1 / label_ratio - 1)) * 100
-                        loss_fn = torch.nn.BCEWithLogitsLoss(
-                            weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                    elif label_ratio > 1:
-                        add_weight = (yyy[0, 0, :, :] / 255 + 1 / (label_ratio - 1)) * 100
-                        loss_fn = torch.nn.BCEWithLogitsLoss(
-                            weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                    elif label_ratio == 1 or label_ratio == 0:
-                        loss_fn = torch.nn.BCEWithLogitsLoss()
                     # Load image to GPU
                     x = Cuda(Variable(torch.from_numpy(xxx).type(torch.FloatTensor)))
                     # Load label to GPU
@@ -406,18 +283,6 @@ def train(bs, sample, vasample, ep, ilr, lr_dec):
                 for iiit in range(minivalist.shape[0]):
                     xxx = minivalist[iiit:iiit + 1, :, :, :]
                     yyy = vminilalist[iiit:iiit + 1, :, :, :]
-                    label_ratio = (yyy > 0).sum() / (
-                            yyy.shape[1] * yyy.shape[2] * yyy.shape[3] - (yyy > 0).sum())
-                    if label_ratio < 1 and label_ratio > 0:
-                        add_weight = (yyy[0, 0, :, :] / 255 + 1 / (1 / label_ratio - 1)) * 100
-                        loss_fn = torch.nn.BCEWithLogitsLoss(
-                            weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                    elif label_ratio > 1:
-                        add_weight = (yyy[0, 0, :, :] / 255 + 1 / (label_ratio - 1)) * 100
-                        loss_fn = torch.nn.BCEWithLogitsLoss(
-                            weight=Cuda(torch.from_numpy(add_weight).type(torch.FloatTensor)))
-                    elif label_ratio == 1 or label_ratio == 0:
-                        loss_fn = torch.nn.BCEWithLogitsLoss()
                     x = Cuda(Variable(torch.from_numpy(xxx).type(torch.FloatTensor)))
                     yyy = Cuda(Variable(torch.from_numpy(yyy / 255).type(torch.FloatTensor)))
                     pred_maskv = model(x)  # .cpu() # .round()
@@ -1,23 +1,22 @@
 import numpy as np # linear algebra
-import pandas as pd # data processing, CSV file I/O (e.g. pd.read_csv)
-import matplotlib.pyplot as plt
-import seaborn as sns
-import skimage.io
 import os
-import shutil
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
-from textwrap import wrap
+import sys
+import time
+import traceback
+import multiprocessing
 np.random.seed(1234)
-import scipy.misc
-import matplotlib.cm as cm
-from imageio import imread
+from imageio import imread, imsave
 
+# This code combines the per-nucleus masks of every training image into one binary label, <id>/label/Combined.png
+# (0 background, 255 nucleus), and optionally a uint16 instance label image, <id>/label/Instances.png (0 background,
+# i + 1 for the i-th mask file in name order; where masks overlap, the later file wins).
+# Each image's masks are read once into one boolean stack that is reduced in a single operation; images are processed
+# across a pool of worker processes.
+# Usage: python combine_mask.py [stage directory, default: inputs/stage_1_train] [number of worker processes, default:
+#        all cores] [1 to also write Instances.png]
 
 
 STAGE1_TRAIN = "inputs/stage_1_train"
-STAGE1_TRAIN_IMAGE_PATTERN = "%s/{}/images/{}.png" % STAGE1_TRAIN
-STAGE1_TRAIN_MASK_PATTERN = "%s/{}/masks/*.png" % STAGE1_TRAIN
 
 # Get image names
 def image_ids_in(root_dir, ignore=['.DS_Store', 'summary.csv', 'stage1_train_labels.csv']):
@@ -30,42 +29,70 @@ def image_ids_in(root_dir, ignore=['.DS_Store', 'summary.csv', 'stage1_train_lab
     return ids
 
 
-# read in images
-def read_image(image_id, space="rgb"):
-    print(image_id)
-    image_file = STAGE1_TRAIN_IMAGE_PATTERN.format(image_id, image_id)
-    image = skimage.io.imread(image_file)
-    # Drop alpha which is not used
-    image = image[:, :, :3]
-    if space == "hsv":
-        image = skimage.color.rgb2hsv(image)
-    return image
+# Read every mask of one image into an (n, height, width) boolean stack; the image size comes from the masks themselves
+def read_masks(directory, image_id):
+    mask_dir = os.path.join(directory, image_id, 'masks')
+    names = sorted(name for name in os.listdir(mask_dir) if name.endswith('.png'))
+    first = imread(os.path.join(mask_dir, names[0]))
+    masks = np.empty((len(names),) + first.shape[:2], dtype=bool)
+    masks[0] = first > 0
+    for index in range(1, len(names)):
+        masks[index] = imread(os.path.join(mask_dir, names[index])) > 0
+    return masks
 
-# Get image width, height and combine masks available.
-def read_image_labels(image_id, space="rgb"):
-    image = read_image(image_id, space = space)
-    mask_file = STAGE1_TRAIN_MASK_PATTERN.format(image_id)
-    masks = skimage.io.imread_collection(mask_file).concatenate()
-    height, width, _ = image.shape
-    num_masks = masks.shape[0]
-    labels = np.zeros((height, width), np.uint16)
-    for index in range(0, num_masks):
-        labels[masks[index] > 0] = 1
+# Combine the masks of one image and write its label(s); returns (image ID, seconds, number of masks, error), where
+# error is None or the formatted traceback
+def combine_image(directory, image_id, instances=False):
+    start = time.time()
     try:
-        os.mkdir(STAGE1_TRAIN+'/'+image_id+'/label')
-    except:
-        pass
-    print(np.max(labels))
-    scipy.misc.imsave(STAGE1_TRAIN+'/'+image_id+'/label/Combined.png', labels)
-    a = imread(STAGE1_TRAIN+'/'+image_id+'/label/Combined.png')
-    a = a/255
+        masks = read_masks(directory, image_id)
+        nucleus = masks.any(axis=0)
+        label_dir = os.path.join(directory, image_id, 'label')
+        if not os.path.exists(label_dir):
+            os.makedirs(label_dir)
+        imsave(os.path.join(label_dir, 'Combined.png'), nucleus.astype(np.uint8) * 255)
+        if instances:
+            # the last mask covering a pixel is the first one in the reversed stack
+            last = len(masks) - masks[::-1].argmax(axis=0)
+            imsave(os.path.join(label_dir, 'Instances.png'), np.where(nucleus, last, 0).astype(np.uint16))
+    except Exception:
+        return image_id, time.time() - start, 0, traceback.format_exc()
+    return image_id, time.time() - start, len(masks), None
 
-    print(np.max(a))
-    return labels
 
+def combine_image_args(args):
+    return combine_image(*args)
 
-train_image_ids = image_ids_in(STAGE1_TRAIN)
 
-for im in train_image_ids:
-    read_image_labels(im)
+# Combine the masks of every image folder of a stage directory, sharded across a pool of worker processes
+# (workers=1 runs serially in this process). Failed images are reported and skipped.
+def combine_masks(directory=STAGE1_TRAIN, workers=None, instances=False):
+    jobs = [(directory, image_id, instances) for image_id in image_ids_in(directory)
+            if os.path.isdir(os.path.join(directory, image_id, 'masks'))]
 
+    start = time.time()
+    if workers == 1:
+        results = [combine_image_args(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = list(pool.imap_unordered(combine_image_args, jobs, chunksize=4))
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+
+    failed = [(image_id, error) for image_id, seconds, count, error in results if error is not None]
+    for image_id, error in failed:
+        print('Failed on ' + image_id + ':\n' + error)
+    print('Combined {} masks of {} images ({} failed) in {:.1f} s with {} worker(s)'.format(
+        sum(count for image_id, seconds, count, error in results), len(results), len(failed), elapsed,
+        workers or multiprocessing.cpu_count()))
+    return failed
+
+
+if __name__ == '__main__':
+    dir_path = sys.argv[1] if len(sys.argv) > 1 else STAGE1_TRAIN
+    n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    write_instances = len(sys.argv) > 3 and sys.argv[3] == '1'
+    combine_masks(dir_path, n_workers, write_instances)
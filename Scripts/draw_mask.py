@@ -6,65 +6,53 @@ import os
 
 # This code is used to generate validation labels from ground truth csv file Kaggle provided
 
+def decode_runs(encoded):
+    '''Parse one EncodedPixels string into arrays of 1-based run starts and run lengths.'''
+    runs = np.array(encoded.split(' '), dtype='int64')
+    n = len(runs) // 2
+    return runs[0:2 * n:2], runs[1:2 * n:2]
+
+
+def paint_runs(flat, starts, lengths, rows):
+    '''Paint runs into a column-major flattened (cols * rows) mask, one slice per run.
+    Reproduces the pixels the original per-pixel walk produced: a run covers its start pixel plus the `length` pixels
+    after it, and a run starting on the last row of a column has its start pixel placed on that row one column to
+    the right.'''
+    for start, length in zip(starts, lengths):
+        flat[start - 1 + (rows if start % rows == 0 else 0)] = 255
+        flat[start:start + length] = 255
+
+
 def draw_mask(csvfile, directory):
     '''Take in a run-length csv file where each line is a mask in one image and outputs a label image of all masks
     combined within each image.'''
     label_csv = pd.read_csv(csvfile)
-    ims = label_csv.groupby('ImageId')["ImageId"].unique()
     ## each image
-    for i in ims:
-        coords = []
-        im_label = label_csv.loc[label_csv['ImageId'] == i[0]].reset_index(drop=True)
-        im_id = im_label['ImageId'][0]
-        masks = im_label['EncodedPixels']
-        rows = im_label["Height"][0]
-        cols = im_label["Width"][0]
+    for im_id, im_label in label_csv.groupby('ImageId', sort=True):
+        rows = im_label["Height"].iloc[0]
+        cols = im_label["Width"].iloc[0]
+        # masks are built as (cols, rows) arrays so that the column-major pixel order is a plain flat index
+        im_mask = np.zeros((cols, rows), dtype='uint8')
         ## each mask
-        for j in masks:
-            ## disect a run-length pixel encoding into individual pixels
+        for j in im_label['EncodedPixels']:
             if not os.path.exists(directory+'/'+im_id+'/masks/'):
                 os.makedirs(directory+'/'+im_id+'/masks/')
-            coords_ea = []
-            mask = j.split(' ')
-            starts = [int(mask[2 * k]) for k in range(int(len(mask) / 2))]
-            stretches = [int(mask[2 * k + 1]) for k in range(int(len(mask) / 2 - 1))]
-            for k in range(len(stretches)):
-                row = starts[k] % rows - 1
-                col = starts[k] // rows
-                coords.append([row, col])
-                coords_ea.append([row, col])
-                for stretch in range(stretches[k]):
-                    row += 1
-                    if row >= rows:
-                        row -= rows
-                        col += 1
-                    coords.append([row, col])
-                    coords_ea.append([row, col])
-            ## single pixel masks with no stretches
-            if len(starts) > len(stretches):
-                for k in range(len(stretches), len(starts)):
-                    row = starts[k] % rows - 1
-                    col = starts[k] // rows
-                    coords.append([row, col])
-            im_mask_ea = np.zeros((rows, cols), dtype='uint8')
-            for coord in coords_ea:
-                im_mask_ea[coord[0], coord[1]] = 255
+            starts, lengths = decode_runs(j)
+            ## as before, the last run only contributes its start pixel, and only to the combined label
+            im_mask_ea = np.zeros((cols, rows), dtype='uint8')
+            paint_runs(im_mask_ea.reshape(-1), starts[:-1], lengths[:-1], rows)
+            im_mask |= im_mask_ea
+            paint_runs(im_mask.reshape(-1), starts[-1:], [0], rows)
             ## outputs images with each single mask
-            imageio.imsave(directory+'/'+im_id+'/masks/mask_'+str(starts[0])+'.png', im_mask_ea)
+            imageio.imsave(directory+'/'+im_id+'/masks/mask_'+str(starts[0])+'.png', np.ascontiguousarray(im_mask_ea.T))
 
-        im_mask = np.zeros((rows, cols), dtype='uint8')
-        for coord in coords:
-            im_mask[coord[0], coord[1]] = 255
         if not os.path.exists(directory+'/'+im_id+'/label/'):
             os.makedirs(directory+'/'+im_id+'/label/')
         ## outputs images with all masks combined
-        imageio.imsave(directory+'/'+im_id+'/label/Combined.png', im_mask)
+        imageio.imsave(directory+'/'+im_id+'/label/Combined.png', np.ascontiguousarray(im_mask.T))
 
 
 
 CSVfile = sys.argv[1]
 Directory = sys.argv[2]
 draw_mask(CSVfile, Directory)
-
-
-
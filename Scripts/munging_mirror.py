@@ -3,23 +3,52 @@ import pandas as pd
 import numpy as np
 import imageio
 import sys
+import time
+import traceback
+import multiprocessing
 import cv2
 from skimage import color
 
-# This code is used to normalize, correct contrast, and mirroring images. 
+# This code is used to normalize, correct contrast, and mirroring images.
+# Usage: python munging_mirror.py <stage directory> [number of worker processes, default: all cores]
 
-def rescale_im(directory):
-    ## load image summary table which contains image handle path, image size and RGB channel info
-    dirs = os.listdir(directory)
-    size_summary_raw = pd.read_csv(directory+'/summary.csv')
-    ## get image size
-    size_summary = size_summary_raw.iloc[:,2:4]
-    min_size = size_summary.apply( max, axis=1 ).min()
-    ## determine the smallest size unit for all images; has to be a power of 2.
-    min_unit = 2**np.ceil(np.log2(min_size))
-    for imid in dirs:
-        if len(imid)<np.max([len(i) for i in dirs]):
-            continue
+def mirror_segments(size, tosize):
+    '''Split one axis of the tosize output into the stretches that copy one whole or partial reflection of the input:
+    yields (output slice, input slice, reversed). The axis is extended by repeated symmetric reflection (edge pixels
+    repeated, as np.pad mode='symmetric') and centered, with the extra pixel of an odd margin going before the image.'''
+    tosize = int(tosize)
+    before = (tosize - size + 1) // 2
+    pos = 0
+    while pos < tosize:
+        ## reflection the output position falls in; even ones are upright copies, odd ones are flipped
+        q, offset = divmod(pos - before, size)
+        stop = min(tosize, before + (q + 1) * size)
+        yield slice(pos, stop), slice(offset, offset + stop - pos), q % 2 == 1
+        pos = stop
+
+
+def mirror_pad(im, tosize, out=None):
+    '''Mirror-pad the first two axes of an image to tosize x tosize, block by block into one preallocated array
+    (out, if given; a 2D image is then broadcast over out's trailing channel axis). Bit-identical to the former
+    concatenate-and-crop mirroring.'''
+    if out is None:
+        out = np.empty((int(tosize), int(tosize)) + im.shape[2:], dtype=im.dtype)
+    views = {}
+    for (flip_r, flip_c) in [(False, False), (False, True), (True, False), (True, True)]:
+        view = im[::-1] if flip_r else im
+        view = view[:, ::-1] if flip_c else view
+        views[flip_r, flip_c] = view[..., None] if out.ndim == im.ndim + 1 else view
+    for out_r, in_r, flip_r in mirror_segments(im.shape[0], tosize):
+        for out_c, in_c, flip_c in mirror_segments(im.shape[1], tosize):
+            out[out_r, out_c] = views[flip_r, flip_c][in_r, in_c]
+    return out
+
+
+def process_image(directory, imid, hsv_cluster, min_unit):
+    '''Normalize, contrast-adjust and mirror-pad one image (and its label, if it has one).
+    Returns (imid, seconds, error), where error is None or the formatted traceback.'''
+    start = time.time()
+    try:
         ## raw image, both in gray channel or RGB channel
         im = imageio.imread(directory+imid+'/images/'+imid+'.png')
         ## convert RGB to gray
@@ -30,95 +59,75 @@ def rescale_im(directory):
         im = (im / im.max() * 255).astype(np.uint8)
         ## each image are extrapolated to size of a multiplication of the size unit
         tosize = np.ceil(np.max(im.shape)/min_unit)*min_unit
-        if size_summary_raw.loc[size_summary_raw['image_id'] == imid, 'hsv_cluster'].values == 1:
+        if hsv_cluster == 1:
             im = 255 - im
         ## adjust image contrast
         im_c = (im - im.mean())
         im_c[im_c < 0] = 0
         im = (im_c / im_c.max() * 255).astype(np.uint8)
 
-        if tosize == im.shape[0] == im.shape[1]:
-            im_pad = np.empty((int(tosize), int(tosize), 3))
-            im_pad[:,:,0] = im_pad[:,:,1] = im_pad[:,:,2] = im
-        else:
-            ## mirroring
-            im_pad = np.empty((int(tosize), int(tosize), 3))
-            row_copy = int(np.ceil((tosize / im.shape[0] - 1)/2))
-            col_copy = int(np.ceil((tosize / im.shape[1] - 1)/2))
-
-            for i in range(3):
-                im_i = im
-                top_left = top_right = bottom_left = bottom_right = np.rot90(np.rot90(im_i))
-                mid_left = mid_right = np.fliplr(im_i)
-                top_mid = bottom_mid = np.flipud(im_i)
-                for j in range(col_copy):
-                    top_mid = np.concatenate((top_left, top_mid, top_right), axis=1)
-                    im_i = np.concatenate((mid_left, im_i, mid_right), axis=1)
-                    bottom_mid = np.concatenate((bottom_left, bottom_mid, bottom_right), axis=1)
-                    top_left = top_right = bottom_left = bottom_right = np.fliplr(top_right)
-                    mid_left = mid_right = np.fliplr(mid_right)
-                for k in range(row_copy):
-                    im_i = np.concatenate((top_mid, im_i, bottom_mid), axis=0)
-                    top_mid = bottom_mid = np.flipud(top_mid)
-
-                row_size_left = int((im_i.shape[0] - tosize) // 2)
-                row_size_right = int((im_i.shape[0] - tosize) // 2 + (im_i.shape[0] - tosize) % 2)
-                col_size_left = int((im_i.shape[1] - tosize) // 2)
-                col_size_right = int((im_i.shape[1] - tosize) // 2 + (im_i.shape[1] - tosize) % 2)
-                if row_size_right == 0 and col_size_right == 0:
-                    im_i = im_i[row_size_left:, col_size_left:]
-                elif row_size_right == 0:
-                    im_i = im_i[row_size_left:, col_size_left:-col_size_right]
-                elif col_size_right == 0:
-                    im_i = im_i[row_size_left:-row_size_right, col_size_left:]
-                else:
-                    im_i = im_i[row_size_left:-row_size_right, col_size_left:-col_size_right]
-                im_pad[:,:,i] = im_i
-        imageio.imsave(directory+imid+'/images/'+imid+'_pad.png', im_pad.astype(np.uint8))
-        
-        
-        ## labels
+        ## mirroring; the gray image is padded once and broadcast to the 3 channels
+        im_pad = np.empty((int(tosize), int(tosize), 3), dtype=np.uint8)
+        mirror_pad(im, tosize, im_pad)
+        imageio.imsave(directory+imid+'/images/'+imid+'_pad.png', im_pad)
+
+
+        ## labels; test images have none
+        if not os.path.exists(directory+imid+'/label/'+'Combined.png'):
+            return imid, time.time() - start, None
+        im = imageio.imread(directory+imid+'/label/'+'Combined.png')
+        tosize = np.ceil(np.max(im.shape)/min_unit)*min_unit
+        im = mirror_pad(im, tosize)
+
+        imageio.imsave(directory+imid+'/label/'+'Combined_pad.png', im.astype(np.uint8))
+    except Exception:
+        return imid, time.time() - start, traceback.format_exc()
+    return imid, time.time() - start, None
+
+
+def process_image_args(args):
+    return process_image(*args)
+
+
+def rescale_im(directory, workers=None):
+    '''Preprocess every image ID folder of a stage directory, sharded across a pool of worker processes
+    (workers=1 runs serially in this process). Failed images are reported and skipped.'''
+    ## load image summary table which contains image handle path, image size and RGB channel info
+    dirs = os.listdir(directory)
+    size_summary_raw = pd.read_csv(directory+'/summary.csv')
+    ## get image size
+    size_summary = size_summary_raw.iloc[:,2:4]
+    min_size = size_summary.apply( max, axis=1 ).min()
+    ## determine the smallest size unit for all images; has to be a power of 2.
+    min_unit = 2**np.ceil(np.log2(min_size))
+    hsv_clusters = dict(zip(size_summary_raw['image_id'], size_summary_raw['hsv_cluster']))
+    ## image ID folders are the longest entries of the directory
+    id_len = np.max([len(i) for i in dirs])
+    jobs = [(directory, imid, hsv_clusters.get(imid), min_unit) for imid in dirs if len(imid) == id_len]
+
+    start = time.time()
+    if workers == 1:
+        results = [process_image_args(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(workers)
         try:
-            im = imageio.imread(directory+imid+'/label/'+'Combined.png')
-            tosize = np.ceil(np.max(im.shape)/min_unit)*min_unit
-            if tosize == im.shape[0] == im.shape[1]:
-                pass
-            else:
-                row_copy = int(np.ceil((tosize / im.shape[0] - 1) / 2))
-                col_copy = int(np.ceil((tosize / im.shape[1] - 1) / 2))
-                top_left = top_right = bottom_left = bottom_right = np.rot90(np.rot90(im))
-                mid_left = mid_right = np.fliplr(im)
-                top_mid = bottom_mid = np.flipud(im)
-                for j in range(col_copy):
-                    top_mid = np.concatenate((top_left, top_mid, top_right), axis=1)
-                    im = np.concatenate((mid_left, im, mid_right), axis=1)
-                    bottom_mid = np.concatenate((bottom_left, bottom_mid, bottom_right), axis=1)
-                    top_left = top_right = bottom_left = bottom_right = np.fliplr(top_right)
-                    mid_left = mid_right = np.fliplr(mid_right)
-                for k in range(row_copy):
-                    im = np.concatenate((top_mid, im, bottom_mid), axis=0)
-                    top_mid = bottom_mid = np.flipud(top_mid)
-                row_size_left = int((im.shape[0] - tosize) // 2)
-                row_size_right = int((im.shape[0] - tosize) // 2 + (im.shape[0] - tosize) % 2)
-                col_size_left = int((im.shape[1] - tosize) // 2)
-                col_size_right = int((im.shape[1] - tosize) // 2 + (im.shape[1] - tosize) % 2)
-                if row_size_right == 0 and col_size_right == 0:
-                    im = im[row_size_left:, col_size_left:]
-                elif row_size_right == 0:
-                    im = im[row_size_left:, col_size_left:-col_size_right]
-                elif col_size_right == 0:
-                    im = im[row_size_left:-row_size_right, col_size_left:]
-                else:
-                    im = im[row_size_left:-row_size_right, col_size_left:-col_size_right]
-
-            imageio.imsave(directory+imid+'/label/'+'Combined_pad.png', im.astype(np.uint8))
-        except:
-            continue
-
-
-
-
-
-dir_path = sys.argv[1]
-rescale_im(dir_path)
+            results = list(pool.imap_unordered(process_image_args, jobs, chunksize=4))
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+
+    failed = [(imid, error) for imid, seconds, error in results if error is not None]
+    for imid, error in failed:
+        print('Failed on ' + imid + ':\n' + error)
+    seconds = np.array([seconds for imid, seconds, error in results])
+    print('Processed {} images ({} failed) in {:.1f} s with {} worker(s); per image: mean {:.2f} s, max {:.2f} s'.format(
+        len(results), len(failed), elapsed, workers or multiprocessing.cpu_count(),
+        seconds.mean() if len(seconds) else 0, seconds.max() if len(seconds) else 0))
+    return failed
+
 
+if __name__ == '__main__':
+    dir_path = sys.argv[1]
+    n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    rescale_im(dir_path, n_workers)
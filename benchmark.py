@@ -0,0 +1,366 @@
+import sys
+import time
+import subprocess
+import resource
+import numpy as np  # linear algebra
+import torch
+from torch.nn import functional as F
+from unet import UNet
+from inference import predict_images, predict_batch
+from precision import autocast, make_scaler
+from losses import WeightedBCELoss
+from evaluate import tile_metric
+from tta import DihedralTTA
+from deploy import fold_batchnorm, freeze_unet, max_difference, block_latency
+from quantize import validation_split
+
+# Micro-benchmarks for the shared UNet code on synthetic data; nothing is read from ../inputs.
+# Usage: python benchmark.py <mode> [options...]
+#   tiles [images] [size] [batch sizes]   test-time tiling: old one-tile-at-a-time loop vs batched predict_images,
+#                                         e.g. python benchmark.py tiles 8 1024 1,4,8,16
+#   memory [sizes] [batch]                peak memory of UNet inference (predict), training (forward + backward) and
+#                                         checkpointed training per input size, e.g. python benchmark.py memory 256,512 2
+#   checkpoint [sizes] [batch] [steps]    recompute cost of UNet(checkpoint=True): seconds per training step with and
+#                                         without checkpointing, next to their peak memory
+#   precision [precisions] [tile] [steps] [batch]
+#                                         training steps/s, inference tiles/s and validation metric() of each
+#                                         precision (precision.py) from the same initial weights on synthetic nuclei,
+#                                         e.g. python benchmark.py precision fp32,bf16 256 20 4
+#   deploy [tile] [batch] [repeats]       per-block latency of the eager UNet vs its BatchNorm-folded channels-last form,
+#                                         end-to-end latency of the frozen TorchScript module (deploy.py) and its
+#                                         largest output difference
+#   family [configs] [tile] [steps] [batch] [train images] [eval images]
+#                                         parameters, GFLOPs per tile, CPU latency per tile and metric() after steps
+#                                         training steps of UNet variants written depth-width-convs-upsample, trained on
+#                                         train images and scored on the next eval images of the validation split
+#                                         (quantize.validation_split, 256x256 tiles); synthetic tile x tile nuclei if
+#                                         the tensor store or vsamples.csv is missing, e.g.
+#                                         python benchmark.py family 7-16-3-bilinear,5-16-2-nearest 256 20 4 16 32
+#   tta [images] [size] [thresholds] [steps]
+#                                         ms per image, share of extra orientations run and metric() of plain
+#                                         prediction, 8-way dihedral TTA and adaptive TTA at each uncertainty
+#                                         threshold (tta.py), after steps training steps on synthetic nuclei
+
+DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+# Seconds taken by fn(), waiting for queued GPU work to finish
+def timed(fn):
+    if DEVICE.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    fn()
+    if DEVICE.type == 'cuda':
+        torch.cuda.synchronize()
+    return time.time() - start
+
+
+def random_images(n, size, seed=0):
+    rng = np.random.RandomState(seed)
+    return [(rng.rand(3, size, size) * 255).astype('float32') for _ in range(n)]
+
+
+# The loop test() used before inference.py: training mode, autograd on, one 256x256 tile per forward pass and one
+# device-to-host copy per tile, pasted back into the full mask
+def legacy_predict(model, im, tile=256):
+    full = np.zeros(im.shape[-2:])
+    for co in range(im.shape[-2] // tile):
+        for ro in range(im.shape[-1] // tile):
+            x = torch.from_numpy(im[None, :, co * tile:(co + 1) * tile, ro * tile:(ro + 1) * tile].copy()).to(DEVICE)
+            full[co * tile:(co + 1) * tile, ro * tile:(ro + 1) * tile] = F.sigmoid(model(x)).cpu().data.numpy()[0, 0]
+    return full
+
+
+def bench_tiles(images='8', size='1024', batch_sizes='1,4,8,16'):
+    ims = random_images(int(images), int(size))
+    model = UNet().to(DEVICE)
+    print('{} images of {}x{} on {}'.format(len(ims), size, size, DEVICE))
+    # warm-up (cuDNN autotuning, allocator)
+    legacy_predict(model, ims[0][:, :256, :256])
+    seconds = timed(lambda: [legacy_predict(model, im) for im in ims])
+    print('{:<40} {:>8.2f} images/s'.format('legacy loop (1 tile, train mode)', len(ims) / seconds))
+    for bs in [int(b) for b in batch_sizes.split(',')]:
+        for overlap, blend in [(0, 'flat'), (64, 'cosine')]:
+            seconds = timed(lambda: list(predict_images(model, ims, 256, overlap, blend, bs)))
+            label = 'batched, batch {}, overlap {}'.format(bs, overlap)
+            print('{:<40} {:>8.2f} images/s'.format(label, len(ims) / seconds))
+
+
+# Peak resident set of this process in bytes. /proc's VmHWM starts afresh with each program, whereas ru_maxrss is
+# inherited across exec from a parent that may already have peaked higher.
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return float(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024.
+
+
+# Peak memory in MB of one UNet pass over a (batch, 3, size, size) input above the memory held before it: device
+# allocations on a GPU, the process' peak resident set on CPU (so call it in a fresh process).
+# mode is 'predict', 'train' or 'checkpoint' (training with checkpointed blocks).
+def peak_memory(size, batch, mode):
+    model = UNet(checkpoint=(mode == 'checkpoint')).to(DEVICE)
+    x = torch.rand(batch, 3, size, size, device=DEVICE)
+    if DEVICE.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        before = torch.cuda.memory_allocated()
+    else:
+        before = peak_rss()
+    if mode == 'predict':
+        model.predict(x)
+    else:
+        model(x).mean().backward()
+    if DEVICE.type == 'cuda':
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - before) / 2. ** 20
+    return (peak_rss() - before) / 2. ** 20
+
+
+def bench_memory(sizes='256,512,1024', batch='1'):
+    print('batch {} on {}; peak MB above the model'.format(batch, DEVICE))
+    print('{:>6} {:>10} {:>10} {:>12}'.format('size', 'predict', 'train', 'checkpoint'))
+    for size in sizes.split(','):
+        peaks = [measure_peak(int(size), int(batch), mode) for mode in ('predict', 'train', 'checkpoint')]
+        print('{:>6} {:>10.0f} {:>10.0f} {:>12.0f}'.format(int(size), *peaks))
+
+
+# Peak memory of one mode in a fresh process on CPU (resident set peaks never go down), in this one on a GPU
+def measure_peak(size, batch, mode):
+    if DEVICE.type == 'cuda':
+        return peak_memory(size, batch, mode)
+    out = subprocess.check_output([sys.executable, __file__, 'peak', str(size), str(batch), mode])
+    return float(out.decode().split()[-1])
+
+
+def bench_checkpoint(sizes='512,1024', batch='1', steps='3'):
+    print('batch {} on {}'.format(batch, DEVICE))
+    print('{:>6} {:>12} {:>12} {:>10} {:>10} {:>12}'.format('size', 'train s', 'ckpt s', 'recompute', 'train MB',
+                                                            'ckpt MB'))
+    for size in [int(s) for s in sizes.split(',')]:
+        x = torch.rand(int(batch), 3, size, size, device=DEVICE)
+        times = []
+        for checkpoint in (False, True):
+            model = UNet(checkpoint=checkpoint).to(DEVICE)
+            # warm-up step
+            model(x).mean().backward()
+            seconds = timed(lambda: [model(x).mean().backward() for _ in range(int(steps))])
+            times.append(seconds / int(steps))
+        peaks = [measure_peak(size, batch, mode) for mode in ('train', 'checkpoint')]
+        print('{:>6} {:>12.2f} {:>12.2f} {:>9.0f}% {:>10.0f} {:>12.0f}'.format(
+            size, times[0], times[1], (times[1] / times[0] - 1) * 100, peaks[0], peaks[1]))
+
+
+# Synthetic nuclei: smoothed noise thresholded into blobs, drawn brighter than a noisy background.
+# Returns (n, 3, size, size) float32 images in 0-255 and (n, 1, size, size) 0/1 labels.
+def synthetic_nuclei(n, size, seed=0):
+    gen = torch.Generator().manual_seed(seed)
+    field = torch.rand(n, 1, size, size, generator=gen)
+    for _ in range(3):
+        field = F.avg_pool2d(field, 9, stride=1, padding=4, count_include_pad=False)
+    field = (field - field.mean((2, 3), keepdim=True)) / field.std((2, 3), keepdim=True)
+    label = (field > 1).float()
+    image = (label * 0.5 + torch.rand(n, 3, size, size, generator=gen) * 0.5) * 255
+    return image, label
+
+
+def bench_precision(precisions='fp32,bf16', tile='256', steps='20', batch='4'):
+    tile, steps, batch = int(tile), int(steps), int(batch)
+    trim, trla = synthetic_nuclei(steps * batch, tile, seed=0)
+    vaim, vala = synthetic_nuclei(4 * batch, tile, seed=1)
+    torch.manual_seed(0)
+    initial = UNet().state_dict()
+    loss_fn = WeightedBCELoss('linear')
+    print('{} training steps of {} x {}x{} tiles on {}'.format(steps, batch, tile, tile, DEVICE))
+    print('{:>6} {:>10} {:>12} {:>10} {:>12}'.format('', 'steps/s', 'inf tiles/s', 'metric', 'agree fp32'))
+    reference = None
+    for precision in precisions.split(','):
+        model = UNet().to(DEVICE)
+        model.load_state_dict(initial)
+        opt = torch.optim.Adam(model.parameters(), lr=1e-3)
+        scaler = make_scaler(precision, DEVICE.type)
+
+        def train_steps():
+            for i in range(steps):
+                with autocast(precision, DEVICE.type):
+                    pred = model(trim[i * batch:(i + 1) * batch].to(DEVICE))
+                loss = loss_fn(pred.float(), trla[i * batch:(i + 1) * batch].to(DEVICE))
+                scaler.scale(loss).backward()
+                scaler.step(opt)
+                scaler.update()
+                opt.zero_grad()
+        train_seconds = timed(train_steps)
+        probs = []
+        inf_seconds = timed(lambda: probs.extend(torch.from_numpy(predict_batch(model, vaim[i:i + batch].numpy(), precision))
+                                                 for i in range(0, len(vaim), batch)))
+        probs = torch.cat(probs)
+        score = tile_metric(probs, vala).mean().item()
+        if reference is None:
+            reference = probs
+        agree = ((probs > 0.5) == (reference > 0.5)).float().mean().item()
+        print('{:>6} {:>10.2f} {:>12.2f} {:>10.4f} {:>12.4f}'.format(precision, steps / train_seconds,
+                                                                    len(vaim) / inf_seconds, score, agree))
+
+
+def bench_deploy(tile='256', batch='4', repeats='5'):
+    tile, batch, repeats = int(tile), int(batch), int(repeats)
+    torch.manual_seed(0)
+    model = UNet().to(DEVICE)
+    # a few training-mode passes give the BatchNorm layers non-trivial running statistics to fold
+    with torch.no_grad():
+        for image in synthetic_nuclei(3, tile)[0].split(1):
+            model(image.to(DEVICE))
+    model.eval()
+    x = synthetic_nuclei(batch, tile, seed=1)[0].to(DEVICE)
+    folded = fold_batchnorm(model).to(memory_format=torch.channels_last)
+    frozen = freeze_unet(model, x)
+    print('{} x {}x{} on {}; ms per call'.format(batch, tile, tile, DEVICE))
+    print('{:<12} {:>10} {:>12}'.format('stage', 'eager', 'folded+CL'))
+    total = [0, 0]
+    for (name, eager), (_, fused) in zip(block_latency(model, x, repeats), block_latency(folded, x, repeats, True)):
+        print('{:<12} {:>10.1f} {:>12.1f}'.format(name, eager * 1000, fused * 1000))
+        total[0] += eager
+        total[1] += fused
+    print('{:<12} {:>10.1f} {:>12.1f}'.format('sum', total[0] * 1000, total[1] * 1000))
+    with torch.no_grad():
+        frozen(x)
+        eager_seconds = timed(lambda: [model(x) for _ in range(repeats)]) / repeats
+        frozen_seconds = timed(lambda: [frozen(x) for _ in range(repeats)]) / repeats
+    print('end to end: eager {:.1f} ms, frozen {:.1f} ms; max |difference| {:.2e}'.format(
+        eager_seconds * 1000, frozen_seconds * 1000, max_difference(model, frozen, x)))
+
+
+# Multiply-accumulate count of the convolutions of a model on input x, times 2
+def conv_flops(model, x):
+    counts = []
+
+    def hook(module, inputs, output):
+        if isinstance(module, torch.nn.ConvTranspose2d):
+            kernel = module.out_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+            counts.append(kernel * inputs[0].numel())
+        else:
+            kernel = module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+            counts.append(kernel * output.numel())
+    handles = [m.register_forward_hook(hook) for m in model.modules()
+               if isinstance(m, (torch.nn.Conv2d, torch.nn.ConvTranspose2d))]
+    try:
+        with torch.no_grad():
+            model(x)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return 2 * sum(counts)
+
+
+FAMILY = '7-16-3-bilinear,6-16-3-bilinear,5-16-3-bilinear,6-16-2-bilinear,6-8-3-bilinear,5-32-2-bilinear,' \
+         '6-16-3-nearest,6-16-3-transpose'
+
+
+# Training and scoring tiles for bench_family: the first train_images images of the validation split and the next
+# eval_images, or synthetic nuclei when the store's inputs are missing. Returns (train images, train labels, eval
+# images, eval labels, description of the data).
+def family_tiles(tile, steps, batch, train_images, eval_images):
+    try:
+        train_items, eval_items = validation_split(train_images, eval_images)
+        train_items, eval_items = list(train_items), list(eval_items)
+    except (IOError, OSError, KeyError) as error:
+        trim, trla = synthetic_nuclei(steps * batch, tile, seed=0)
+        vaim, vala = synthetic_nuclei(4 * batch, tile, seed=1)
+        source = 'SYNTHETIC nuclei, no validation store ({}); scores do not rank variants'.format(error)
+        return trim, trla, vaim, vala, source
+    trim = torch.cat([item['image'] for item in train_items]).float()
+    trla = torch.cat([item['label'] for item in train_items])
+    vaim = torch.cat([item['image'] for item in eval_items]).float()
+    vala = torch.cat([item['label'] for item in eval_items])
+    source = 'validation split: {} images ({} tiles) to train, {} images ({} tiles) to score'.format(
+        len(train_items), len(trim), len(eval_items), len(vaim))
+    return trim, trla, vaim, vala, source
+
+
+def bench_family(configs=FAMILY, tile='256', steps='20', batch='4', train_images='16', eval_images='32'):
+    tile, steps, batch = int(tile), int(steps), int(batch)
+    trim, trla, vaim, vala, source = family_tiles(tile, steps, batch, int(train_images), int(eval_images))
+    loss_fn = WeightedBCELoss('linear')
+    print('{} training steps of {} x {}x{} tiles on {}; latency on the CPU'.format(steps, batch, trim.shape[-2],
+                                                                                   trim.shape[-1], DEVICE))
+    print('Data: ' + source)
+    print('{:<18} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('config', 'params M', 'GFLOPs', 'ms/tile',
+                                                             'train s', 'metric'))
+    for config in configs.split(','):
+        depth, width, convs, upsample = config.split('-')
+        torch.manual_seed(0)
+        model = UNet(depth=int(depth), width=int(width), convs=int(convs), upsample=upsample).to(DEVICE)
+        opt = torch.optim.Adam(model.parameters(), lr=1e-3)
+
+        def train_steps():
+            for i in range(steps):
+                # cycle through the training tiles
+                rows = torch.arange(i * batch, (i + 1) * batch) % len(trim)
+                pred = model(trim[rows].to(DEVICE))
+                loss_fn(pred, trla[rows].to(DEVICE)).backward()
+                opt.step()
+                opt.zero_grad()
+        train_seconds = timed(train_steps)
+        probs = torch.cat([torch.from_numpy(predict_batch(model, vaim[i:i + batch].numpy()))
+                           for i in range(0, len(vaim), batch)])
+        score = tile_metric(probs, vala).mean().item()
+        model = model.cpu().eval()
+        x = vaim[:batch]
+        params = sum(p.numel() for p in model.parameters())
+        flops = conv_flops(model, x[:1])
+        with torch.no_grad():
+            model(x)
+            start = time.time()
+            model(x)
+            seconds = (time.time() - start) / x.shape[0]
+        print('{:<18} {:>10.2f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.4f}'.format(
+            config, params / 1e6, flops / 1e9, seconds * 1000, train_seconds, score))
+
+
+def bench_tta(images='4', size='512', thresholds='0.2,0.5,0.7', steps='20'):
+    images, size, steps = int(images), int(size), int(steps)
+    trim, trla = synthetic_nuclei(steps * 2, 256, seed=0)
+    teim, tela = synthetic_nuclei(images, size, seed=1)
+    torch.manual_seed(0)
+    model = UNet().to(DEVICE)
+    opt = torch.optim.Adam(model.parameters(), lr=1e-3)
+    loss_fn = WeightedBCELoss('linear')
+    for i in range(steps):
+        loss_fn(model(trim[i * 2:(i + 1) * 2].to(DEVICE)), trla[i * 2:(i + 1) * 2].to(DEVICE)).backward()
+        opt.step()
+        opt.zero_grad()
+    ims = [im.numpy() for im in teim]
+    runs = [('plain', None), ('tta x8', DihedralTTA())]
+    runs += [('adaptive ' + t, DihedralTTA(threshold=float(t))) for t in thresholds.split(',')]
+    print('{} images of {}x{} on {}, 256 tiles, {} training steps'.format(images, size, size, DEVICE, steps))
+    print('{:<16} {:>10} {:>10} {:>10} {:>10}'.format('', 'ms/image', 'added ms', 'extra', 'metric'))
+    base = None
+    for name, tta in runs:
+        probs = []
+        list(predict_images(model, ims[:1], 256, 64, 'cosine', 1, 'fp32', tta))
+        if tta is not None:
+            tta.tiles = tta.extra = 0
+        seconds = timed(lambda: probs.extend(prob for idx, prob in predict_images(model, ims, 256, 64, 'cosine', 1,
+                                                                                   'fp32', tta))) / images
+        base = seconds if base is None else base
+        score = tile_metric(torch.from_numpy(np.stack(probs)), tela).mean().item()
+        print('{:<16} {:>10.1f} {:>10.1f} {:>9.0%} {:>10.4f}'.format(name, seconds * 1000, (seconds - base) * 1000,
+                                                                     tta.coverage() if tta else 0, score))
+
+
+def bench_peak(size, batch, mode):
+    print(peak_memory(int(size), int(batch), mode))
+
+
+MODES = {'tiles': bench_tiles, 'memory': bench_memory, 'checkpoint': bench_checkpoint, 'precision': bench_precision,
+         'deploy': bench_deploy, 'family': bench_family, 'tta': bench_tta, 'peak': bench_peak}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in MODES:
+        print('usage: python benchmark.py <' + '|'.join(sorted(MODES)) + '> [options...]')
+        sys.exit(1)
+    MODES[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,164 @@
+import copy
+import sys
+import time
+import torch
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+# Deployment form of a trained unet.UNet for inference. Every Conv2d -> BatchNorm2d pair is folded into a single
+# convolution using the running statistics (the BatchNorm becomes an Identity), weights and activations are switched
+# to the channels-last layout that oneDNN/cuDNN convolutions prefer, and the result is traced and frozen with
+# TorchScript, which lets the JIT fuse each convolution with the ReLU that follows it.
+# The eager UNet is left untouched; outputs of the frozen module match its eval-mode outputs within float tolerance.
+# Run as a script, it exports a training checkpoint as a standalone artifact for run_inference.py:
+#   python deploy.py <checkpoint, e.g. ../out1/unet-30> <artifact> [torchscript|onnx] [example tile size]
+# Both formats accept any batch size and any height and width that are multiples of 64.
+
+EXPORT_FORMATS = ('torchscript', 'onnx')
+
+# (convolution, batch norm) attribute pairs of a UNet module; other modules have none
+def fold_pairs(module):
+    name = type(module).__name__
+    if name in ('UNet_down_block', 'UNet_up_block'):
+        return [('conv{}'.format(i), 'bn{}'.format(i)) for i in range(1, module.convs + 1)]
+    if name == 'UNet':
+        return [('mid_conv{}'.format(i), 'bn{}'.format(i)) for i in range(1, module.convs + 1)] + \
+            [('last_conv1', 'last_bn')]
+    return []
+
+
+# Eval-mode copy of a UNet with every BatchNorm folded into the convolution before it
+def fold_batchnorm(model):
+    model = copy.deepcopy(model).eval()
+    model.checkpoint = False
+    for module in model.modules():
+        for conv, bn in fold_pairs(module):
+            setattr(module, conv, fuse_conv_bn_eval(getattr(module, conv), getattr(module, bn)))
+            setattr(module, bn, torch.nn.Identity())
+    return model
+
+
+# Converts its input to channels-last before running the wrapped model, so callers can keep passing NCHW tensors
+class ChannelsLast(torch.nn.Module):
+    def __init__(self, model):
+        super(ChannelsLast, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x.contiguous(memory_format=torch.channels_last))
+
+
+# Folded, channels-last, traced and frozen copy of a UNet. example is an input of the size used at inference; the
+# traced graph has no size-dependent control flow, so other sizes that are multiples of 64 work as well.
+# optimize applies torch.jit.optimize_for_inference, whose prepacked convolutions are tied to the current machine;
+# leave it off for modules that are saved to disk.
+def freeze_unet(model, example, channels_last=True, optimize=True):
+    model = fold_batchnorm(model)
+    if channels_last:
+        model = ChannelsLast(model.to(memory_format=torch.channels_last)).eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        frozen = torch.jit.freeze(traced)
+        if optimize and hasattr(torch.jit, 'optimize_for_inference'):
+            frozen = torch.jit.optimize_for_inference(frozen)
+    return frozen
+
+
+# Largest absolute difference between the eval-mode eager model and a deployed module on input x
+def max_difference(model, deployed, x):
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            return (model(x) - deployed(x)).abs().max().item()
+    finally:
+        model.train(was_training)
+
+
+# Mean seconds per call of each stage of a UNet (eager, eval mode), in forward() order: the down blocks, the middle
+# convolutions, the up blocks and the output convolutions. Returns a list of (name, seconds).
+def block_latency(model, x, repeats=5, channels_last=False):
+    def timed(fn, *args):
+        fn(*args)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeats):
+            out = fn(*args)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        return out, (time.time() - start) / repeats
+
+    def middle(x):
+        for i in range(1, model.convs + 1):
+            x = model.relu(getattr(model, 'bn{}'.format(i))(getattr(model, 'mid_conv{}'.format(i))(x)))
+        return x
+
+    def last(x):
+        return model.last_conv2(model.relu(model.last_bn(model.last_conv1(x))))
+
+    if channels_last:
+        x = x.contiguous(memory_format=torch.channels_last)
+    report = []
+    skips = []
+    with torch.no_grad():
+        for i in range(1, model.depth + 1):
+            x, seconds = timed(getattr(model, 'down_block{}'.format(i)), x)
+            skips.append(x)
+            report.append(('down_block{}'.format(i), seconds))
+        x, seconds = timed(middle, x)
+        report.append(('mid_conv', seconds))
+        for i in range(1, model.depth):
+            x, seconds = timed(getattr(model, 'up_block{}'.format(i)), skips[-1 - i], x)
+            report.append(('up_block{}'.format(i), seconds))
+        x, seconds = timed(last, x)
+        report.append(('last_conv', seconds))
+    return report
+
+
+# Eval-mode unet.UNet on the CPU from a checkpoint saved by the training scripts ({'epoch', 'state_dict', 'optimizer'}
+# and the UNet's constructor arguments under 'unet') or from a bare state_dict; checkpoints without 'unet' are the
+# default architecture
+def load_checkpoint(path):
+    from unet import UNet
+    checkpoint = torch.load(path, map_location='cpu')
+    config = {}
+    if 'state_dict' in checkpoint:
+        config = checkpoint.get('unet') or {}
+        checkpoint = checkpoint['state_dict']
+    model = UNet(**config)
+    model.load_state_dict(checkpoint)
+    return model.eval()
+
+
+# Save a folded, frozen TorchScript module of a UNet to path; torch.jit.load(path) needs neither this repo nor unet.py
+def export_torchscript(model, path, tile=256):
+    example = torch.rand(1, 3, tile, tile)
+    frozen = freeze_unet(model, example, optimize=False)
+    torch.jit.save(frozen, path)
+    return max_difference(model, frozen, example)
+
+
+# Save a BatchNorm-folded UNet as an ONNX graph with dynamic batch, height and width (needs the onnx package)
+def export_onnx(model, path, tile=256):
+    example = torch.rand(1, 3, tile, tile)
+    folded = fold_batchnorm(model)
+    with torch.no_grad():
+        torch.onnx.export(folded, example, path, input_names=['image'], output_names=['logits'],
+                          dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'},
+                                        'logits': {0: 'batch', 2: 'height', 3: 'width'}},
+                          opset_version=17)
+    return max_difference(model, folded, example)
+
+
+if __name__ == '__main__':
+    checkpoint_path = sys.argv[1]
+    artifact = sys.argv[2]
+    export_format = sys.argv[3] if len(sys.argv) > 3 else 'torchscript'
+    export_tile = int(sys.argv[4]) if len(sys.argv) > 4 else 256
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError('unknown export format ' + str(export_format))
+    unet = load_checkpoint(checkpoint_path)
+    exporter = export_torchscript if export_format == 'torchscript' else export_onnx
+    difference = exporter(unet, artifact, export_tile)
+    print('Exported {} as {} to {}; max |difference| from the checkpoint: {:.2e}'.format(
+        checkpoint_path, export_format, artifact, difference))
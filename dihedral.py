@@ -0,0 +1,101 @@
+import numpy as np  # linear algebra
+
+# The 8 symmetries of the square, applied to the last two (H, W) axes of an array. Indices 0-5 follow the order the
+# old dataloader materialized its augmentations in (original, rot90 x3, fliplr, flipud); 6 and 7 are the two
+# transposes it never used. Every transform is a NumPy view, so no pixel data is copied.
+IDENTITY, ROT90, ROT180, ROT270, FLIPLR, FLIPUD, TRANSPOSE, ANTITRANSPOSE = range(8)
+N_DIHEDRAL = 8
+# transforms the training scripts have always used, in their historical order
+DEFAULT_TRANSFORMS = (IDENTITY, ROT90, ROT180, ROT270, FLIPLR, FLIPUD)
+
+
+# Apply dihedral transform k to the (H, W) axes of arr; returns a view
+def dihedral(arr, k):
+    if k == IDENTITY:
+        return arr
+    elif k in (ROT90, ROT180, ROT270):
+        return np.rot90(arr, k, axes=(-2, -1))
+    elif k == FLIPLR:
+        return arr[..., :, ::-1]
+    elif k == FLIPUD:
+        return arr[..., ::-1, :]
+    elif k == TRANSPOSE:
+        return np.swapaxes(arr, -2, -1)
+    elif k == ANTITRANSPOSE:
+        return np.swapaxes(arr, -2, -1)[..., ::-1, ::-1]
+    raise ValueError('unknown dihedral transform {}'.format(k))
+
+
+# Index of the transform that undoes transform k (rotations by 90/270 undo each other, the rest are involutions)
+def inverse(k):
+    if k == ROT90:
+        return ROT270
+    elif k == ROT270:
+        return ROT90
+    return k
+
+
+# All requested transforms of one sample, indexed like the old (6, C, H, W) augmented array.
+# stack[i] is a zero-copy view of transform transforms[i]. Slicing the leading axis (stack[i:i + 1, :, :, :], as the
+# training loops do) returns a contiguous copy of just the requested transforms, since torch.from_numpy does not accept
+# the negative strides of flipped views.
+class DihedralStack(object):
+    def __init__(self, base, transforms=DEFAULT_TRANSFORMS):
+        self.base = base
+        self.transforms = tuple(transforms)
+
+    @property
+    def shape(self):
+        return (len(self.transforms),) + tuple(dihedral(self.base, self.transforms[0]).shape)
+
+    def __len__(self):
+        return len(self.transforms)
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        if isinstance(key, slice):
+            picked = [dihedral(self.base, k) for k in self.transforms[key]]
+            return np.ascontiguousarray(np.stack(picked))[(slice(None),) + rest]
+        return dihedral(self.base, self.transforms[key])[rest]
+
+    def __array__(self, dtype=None, copy=None):
+        stacked = np.stack([dihedral(self.base, k) for k in self.transforms])
+        return stacked if dtype is None else stacked.astype(dtype)
+
+
+# Wrap a list-like of un-augmented (1, C, H, W) samples (e.g. tensor_store.MappedArrays) so that item i is a
+# DihedralStack over the original. Set .transforms (or call set_transforms on the sample dict) between epochs to
+# change which orientations the training loop sees.
+class DihedralSamples(object):
+    def __init__(self, samples, transforms=DEFAULT_TRANSFORMS):
+        self.samples = samples
+        self.transforms = tuple(transforms)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        return DihedralStack(self.samples[idx][0], self.transforms)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+# Stored originals behind a dataloader() entry (training splits are wrapped in DihedralSamples)
+def original(samples):
+    return getattr(samples, 'samples', samples)
+
+
+# Select the transforms used for images, labels (and cached weight maps) of a training sample dict, e.g. once per epoch
+def set_transforms(sample, transforms):
+    for key in ('Image', 'Label', 'Weight'):
+        if isinstance(sample.get(key), DihedralSamples):
+            sample[key].transforms = tuple(transforms)
+
+
+# Draw n distinct transforms out of the 8, e.g. a fresh set of 6 orientations each epoch
+def random_transforms(n=len(DEFAULT_TRANSFORMS), rng=np.random):
+    return tuple(int(k) for k in rng.permutation(N_DIHEDRAL)[:n])
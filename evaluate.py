@@ -0,0 +1,163 @@
+import os
+import sys
+import csv
+import gzip
+import traceback
+import multiprocessing
+import numpy as np  # linear algebra
+from rle import rles_to_labels
+
+# Validation scores shared by the benchmark and deployment tools, and the contest's instance-level score.
+# metric() of the training scripts is a pixel IoU. The contest scores every image by its precision
+# tp / (tp + fp + fn) at IoU thresholds 0.5, 0.55, ..., 0.95, where a predicted nucleus is a true positive if it
+# overlaps a ground-truth nucleus with IoU above the threshold, averaged over thresholds and then over images. Here the
+# IoU of every (ground truth, prediction) pair comes from one bincount contingency table, and all thresholds are
+# scored at once.
+# Usage: python evaluate.py <submission csv> <stage directory> [samples csv] [workers] [per-image csv]
+#   scores a submission (ImageId, EncodedPixels) against <stage directory>/<id>/masks/*.png; the samples csv (with
+#   Type and ID columns, see Scripts/Sample_prep.py) adds a fluorescence/histology/light breakdown
+
+THRESHOLDS = np.arange(0.5, 1.0, 0.05)
+
+
+# metric() of the training scripts, per tile: (tp + 1) / (predicted + label - tp + 1) on 0.5-thresholded probabilities
+# (a smoothed pixel IoU). prob and target are (N, ...) tensors; returns the N scores.
+def tile_metric(prob, target):
+    pred = (prob > 0.5).reshape(prob.shape[0], -1).float()
+    target = target.reshape(target.shape[0], -1).float()
+    tp = (pred * target).sum(1)
+    return (tp + 1) / (pred.sum(1) + target.sum(1) - tp + 1)
+
+
+# Flattened labels renumbered 0 (background), 1, 2, ... and the number of labels including background
+def relabel(labels):
+    ids, inverse = np.unique(np.asarray(labels).ravel(), return_inverse=True)
+    inverse = inverse.ravel()
+    if len(ids) and ids[0] == 0:
+        return inverse, len(ids)
+    return inverse + 1, len(ids) + 1
+
+
+# (n_true, n_pred) IoU of every pair of nuclei of two labelled images (0 is background; other labels need not be
+# consecutive)
+def iou_matrix(truth, pred):
+    truth, n_true = relabel(truth)
+    pred, n_pred = relabel(pred)
+    joint = np.bincount(truth * n_pred + pred, minlength=n_true * n_pred).reshape(n_true, n_pred)
+    areas_true = joint.sum(1)[1:, None]
+    areas_pred = joint.sum(0)[None, 1:]
+    inter = joint[1:, 1:]
+    return inter / np.maximum(areas_true + areas_pred - inter, 1).astype('float64')
+
+
+# Contest precision of one image at each threshold; an image with no nuclei and no predictions scores 1
+def average_precision(truth, pred, thresholds=THRESHOLDS):
+    iou = iou_matrix(truth, pred)
+    n_true, n_pred = iou.shape
+    if n_true == 0 and n_pred == 0:
+        return np.ones(len(thresholds))
+    # above IoU 0.5 a nucleus can match at most one nucleus of the other image, so matches can simply be counted
+    tp = (iou[..., None] > thresholds).sum((0, 1))
+    return tp / (n_true + n_pred - tp).astype('float64')
+
+
+# Labelled image of the per-nucleus masks (<image directory>/masks/*.png); label i + 1 for the i-th file in name order,
+# the last one winning where masks overlap (as Scripts/combine_mask.py's Instances.png). Without any mask the image is
+# all background, sized from <image directory>/images/*.png.
+def read_masks(directory):
+    from imageio import imread
+    names = sorted(name for name in os.listdir(os.path.join(directory, 'masks')) if name.endswith('.png'))
+    if not names:
+        images = sorted(name for name in os.listdir(os.path.join(directory, 'images')) if name.endswith('.png'))
+        return np.zeros(imread(os.path.join(directory, 'images', images[0])).shape[:2], 'int32')
+    first = imread(os.path.join(directory, 'masks', names[0]))
+    masks = np.empty((len(names),) + first.shape[:2], dtype=bool)
+    masks[0] = first > 0
+    for index in range(1, len(names)):
+        masks[index] = imread(os.path.join(directory, 'masks', names[index])) > 0
+    # the last mask covering a pixel is the first one in the reversed stack
+    return np.where(masks.any(0), len(names) - masks[::-1].argmax(0), 0).astype('int32')
+
+
+# (image ID, per-threshold precision, error) of one image; pool worker for evaluate(). An image that cannot be scored
+# (unreadable masks, runs outside the image) scores 0 at every threshold, with error the formatted traceback.
+def score_image(args):
+    directory, imid, rles = args
+    try:
+        truth = read_masks(os.path.join(directory, imid))
+        return imid, average_precision(truth, rles_to_labels(rles, truth.shape)), None
+    except Exception:
+        return imid, np.zeros(len(THRESHOLDS)), traceback.format_exc()
+
+
+# Run lists of every image of a submission csv (optionally .gz), by ImageId; images without detections have no runs.
+# A .gz file cut off inside a gzip member (a run killed mid-write) yields the rows read before the cut.
+def read_submission(path):
+    rles = {}
+    with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path)) as f:
+        try:
+            for row in csv.DictReader(f):
+                runs = rles.setdefault(row['ImageId'], [])
+                if row['EncodedPixels'].strip():
+                    runs.append([int(y) for y in row['EncodedPixels'].split()])
+        except EOFError:
+            print('Warning: ' + path + ' ends in a truncated gzip member; keeping the rows read before it')
+    return rles
+
+
+# Per-image precisions of a submission ({image ID: run lists}) against the masks of every image folder of a stage
+# directory, across a pool of worker processes (workers=1 runs serially). Images that fail are reported and score 0.
+# Returns {image ID: per-threshold precision}.
+def evaluate(rles, directory, workers=None):
+    ids = sorted(name for name in os.listdir(directory) if os.path.isdir(os.path.join(directory, name, 'masks')))
+    jobs = [(directory, imid, rles.get(imid, [])) for imid in ids]
+    if workers == 1:
+        results = [score_image(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = list(pool.imap_unordered(score_image, jobs, chunksize=4))
+        finally:
+            pool.close()
+            pool.join()
+    failed = sorted((imid, error) for imid, precisions, error in results if error is not None)
+    for imid, error in failed:
+        print('Failed on ' + imid + ' (scored 0):\n' + error)
+    if failed:
+        print('{} of {} images failed'.format(len(failed), len(results)))
+    return dict((imid, precisions) for imid, precisions, error in results)
+
+
+# Print the mean score, its value at each threshold and, given {image ID: type}, the breakdown by image type
+def print_scores(scores, types=None):
+    groups = [('all', sorted(scores))]
+    if types:
+        for kind in sorted(set(types.values())):
+            groups.append((kind, sorted(imid for imid in scores if types.get(imid) == kind)))
+    print('{:<14} {:>7} {:>7} '.format('', 'images', 'mAP') + ' '.join('{:>5.2f}'.format(t) for t in THRESHOLDS))
+    for name, ids in groups:
+        if not ids:
+            continue
+        precisions = np.mean([scores[imid] for imid in ids], axis=0)
+        print('{:<14} {:>7} {:>7.4f} '.format(name, len(ids), precisions.mean()) +
+              ' '.join('{:>5.3f}'.format(p) for p in precisions))
+
+
+if __name__ == '__main__':
+    submission = read_submission(sys.argv[1])
+    stage_dir = sys.argv[2]
+    image_types = None
+    if len(sys.argv) > 3 and sys.argv[3]:
+        with open(sys.argv[3]) as samples:
+            image_types = dict((row['ID'], row['Type']) for row in csv.DictReader(samples))
+    n_workers = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    image_scores = evaluate(submission, stage_dir, n_workers)
+    print_scores(image_scores, image_types)
+    if len(sys.argv) > 5:
+        with open(sys.argv[5], 'w') as out:
+            writer = csv.writer(out, lineterminator='\n')
+            writer.writerow(['ImageId', 'Type', 'mAP'] + ['{:.2f}'.format(t) for t in THRESHOLDS])
+            for image_id in sorted(image_scores):
+                writer.writerow([image_id, (image_types or {}).get(image_id, ''),
+                                 '{:.4f}'.format(image_scores[image_id].mean())] +
+                                ['{:.4f}'.format(p) for p in image_scores[image_id]])
@@ -0,0 +1,152 @@
+import numpy as np  # linear algebra
+import torch
+from torch.nn import functional as F
+from precision import autocast
+
+# Sliding-window inference for the UNet scripts. test() used to cut mirror-padded images into non-overlapping 256x256
+# tiles, predict them one at a time and paste them back, which leaves seams at tile borders and only works for images
+# padded to multiples of 256. Here tiles overlap, each tile's prediction is weighted by a window that fades towards
+# its borders, and the weighted sum is normalized in a preallocated buffer of the image's own size. Images of any size
+# are accepted: sides shorter than a tile (or not a multiple of the UNet's total downsampling) are mirrored just enough
+# to fit. Tiles of several images can share a forward pass (predict_images).
+
+BLENDS = ('cosine', 'gaussian', 'flat')
+# The default UNet max-pools 6 times, so its input sides must be multiples of 2 ** 6; models with a stride attribute
+# (unet.UNet) declare their own
+UNET_STRIDE = 64
+
+
+# 2D blending window for one tile: 'cosine' (Hann), 'gaussian' (sigma = tile / 8) or 'flat' (plain averaging).
+# Every entry is strictly positive, so image borders covered by a single tile are still normalized correctly.
+def blend_window(tile, blend='cosine'):
+    if blend not in BLENDS:
+        raise ValueError('unknown blending window ' + str(blend))
+    pos = np.arange(tile, dtype='float64') + 0.5
+    if blend == 'cosine':
+        w = 0.5 - 0.5 * np.cos(2 * np.pi * pos / tile)
+    elif blend == 'gaussian':
+        w = np.exp(-0.5 * ((pos - tile / 2.) / (tile / 8.)) ** 2)
+    else:
+        w = np.ones(tile)
+    w = np.maximum(w, 1e-4)
+    return np.outer(w, w).astype('float32')
+
+
+# Tile origins along one side of the given length: every stride pixels, plus one last tile flush with the end
+def tile_origins(length, tile, stride):
+    origins = list(range(0, length - tile + 1, stride))
+    if origins[-1] != length - tile:
+        origins.append(length - tile)
+    return origins
+
+
+# Mirror a (C, H, W) image so that both sides are at least tile and a multiple of multiple; returns the padded image and
+# the (top, left) offset of the original inside it
+def fit_image(im, tile, multiple=UNET_STRIDE):
+    pads = []
+    for side in im.shape[-2:]:
+        target = max(side, tile)
+        target = int(np.ceil(target / float(multiple)) * multiple)
+        pads.append(((target - side + 1) // 2, (target - side) // 2))
+    if pads[0] == (0, 0) and pads[1] == (0, 0):
+        return im, (0, 0)
+    return np.pad(im, ((0, 0),) + tuple(pads), mode='symmetric'), (pads[0][0], pads[1][0])
+
+
+# Device of a model's parameters; modules without parameters (frozen TorchScript, deploy.py) run on the CPU
+def model_device(model):
+    param = next(model.parameters(), None)
+    return param.device if param is not None else torch.device('cpu')
+
+
+# Sigmoid probabilities for a (N, C, tile, tile) float32 batch, on the model's device and at the given precision
+# (precision.PRECISIONS). Models with a predict() method (unet.UNet) use that inference entry point instead of forward().
+def predict_batch(model, batch, precision='fp32'):
+    device = model_device(model)
+    run = getattr(model, 'predict', model)
+    with torch.no_grad(), autocast(precision, device.type):
+        x = torch.from_numpy(batch).to(device)
+        logits = run(x)
+    return F.sigmoid(logits.float()).cpu().numpy()
+
+
+# Predict a (C, H, W) image of any size with overlapping tiles; returns the (H, W) float32 probability map.
+# overlap is the number of pixels shared by neighbouring tiles; batch_size tiles go through the model at once.
+def predict_tiled(model, im, tile=256, overlap=64, blend='cosine', batch_size=4, precision='fp32', predict=None):
+    for idx, prob in predict_images(model, [im], tile, overlap, blend, batch_size, precision, predict):
+        return prob
+
+
+# Sliding-window state of one image: its fitted copy, tile origins and the blending accumulators
+class TiledImage(object):
+    def __init__(self, im, tile, overlap, multiple=UNET_STRIDE):
+        self.height, self.width = im.shape[-2:]
+        self.im, (self.top, self.left) = fit_image(np.asarray(im, dtype='float32'), tile, multiple)
+        self.acc = np.zeros(self.im.shape[-2:], dtype='float32')
+        self.norm = np.zeros(self.im.shape[-2:], dtype='float32')
+        self.origins = [(y, x) for y in tile_origins(self.im.shape[-2], tile, tile - overlap)
+                        for x in tile_origins(self.im.shape[-1], tile, tile - overlap)]
+        self.pending = len(self.origins)
+
+    def result(self):
+        self.acc /= self.norm
+        return self.acc[self.top:self.top + self.height, self.left:self.left + self.width]
+
+
+# Predict a sequence of (C, H, W) images of any sizes, yielding (position, (H, W) probability map) in input order.
+# Tiles of consecutive images are packed into the same forward pass, so small images do not leave batches half empty;
+# each batch runs without autograd, in eval mode (running BatchNorm statistics), and is copied back to the host once.
+# predict(model, batch, precision) turns a batch of tiles into probabilities: predict_batch by default, or e.g. a
+# tta.DihedralTTA for test-time augmentation.
+def predict_images(model, images, tile=256, overlap=64, blend='cosine', batch_size=4, precision='fp32', predict=None):
+    if not 0 <= overlap < tile:
+        raise ValueError('overlap must be in [0, tile)')
+    if predict is None:
+        predict = predict_batch
+    window = blend_window(tile, blend)
+    multiple = getattr(model, 'stride', UNET_STRIDE)
+    # frozen TorchScript modules (deploy.py) no longer have a training flag; they always run in eval mode
+    was_training = getattr(model, 'training', None)
+    if was_training is not None:
+        model.eval()
+    try:
+        batch = None
+        chunk = []
+        for idx, im in enumerate(images):
+            state = TiledImage(im, tile, overlap, multiple)
+            if batch is None:
+                batch = np.empty((batch_size, state.im.shape[0], tile, tile), dtype='float32')
+            for (y, x) in state.origins:
+                batch[len(chunk)] = state.im[:, y:y + tile, x:x + tile]
+                chunk.append((idx, state, y, x))
+                if len(chunk) == batch_size:
+                    for item in scatter(predict(model, batch, precision), chunk, window, tile):
+                        yield item
+                    chunk = []
+        if chunk:
+            for item in scatter(predict(model, batch[:len(chunk)], precision), chunk, window, tile):
+                yield item
+    finally:
+        if was_training is not None:
+            model.train(was_training)
+
+
+# Add a batch of predicted tiles into their images' accumulators; returns the images that are now complete
+def scatter(probs, chunk, window, tile):
+    finished = []
+    for i, (idx, state, y, x) in enumerate(chunk):
+        state.acc[y:y + tile, x:x + tile] += probs[i, 0] * window
+        state.norm[y:y + tile, x:x + tile] += window
+        state.pending -= 1
+        if state.pending == 0:
+            finished.append((idx, state.result()))
+    return finished
+
+
+# Original (C, h, w) region of an image mirror-padded by munging_mirror.py; dim is the store's [(width, height)].
+# munging_mirror puts the extra pixel of an odd margin before the image.
+def unpad(im, dim):
+    width, height = dim[0]
+    top = (im.shape[-2] - height + 1) // 2
+    left = (im.shape[-1] - width + 1) // 2
+    return im[..., top:top + height, left:left + width]
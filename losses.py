@@ -0,0 +1,62 @@
+import torch
+from torch.nn import functional as F
+
+# Class-balance weighted BCE used by the training scripts. Every script derived its per-pixel weights from the
+# positive/negative ratio of the label with NumPy branches and built a new BCEWithLogitsLoss per sample; here the weight
+# maps for a whole batch of labels are computed on the labels' device with tensor ops.
+#
+# For a label with pos positive and neg negative pixels, the scripts' offset 1 / (1 / ratio - 1) (ratio < 1) or
+# 1 / (ratio - 1) (ratio > 1) is min(pos, neg) / |neg - pos|; call it b. The weighting schemes are then:
+#   'linear'  (t + b) * 100                                   RH_seg.py, Main_RH_crp_*.py, Main_ji_pixelppv_dataloader.py
+#   'sqrt'    sqrt((t + b) / (1 + b) * 255)                   Main_RH_sqrt.py
+#   'sqrtb'   (t + sqrt(b)) / (1 + sqrt(b)) * 255             Main_RH_sqrt2.py
+#   'clip'    max((t + b) / (1 + b) * 255, param)             Main_BD_*.py (param 10 ... 120), Main_RH_ceiling.py (1.34)
+#   'none'    param everywhere                                Main_BD_noweight.py (255)
+# where t is the 0/1 label. Labels without positives or with exactly as many positives as negatives get the scheme's
+# uniform weight (1 for 'linear', 255 otherwise), as the scripts' ratio == 1 branch did.
+
+SCHEMES = ('linear', 'sqrt', 'sqrtb', 'clip', 'none')
+
+
+# Per-pixel weights for a batch of 0/1 labels (N, 1, H, W); returns a tensor of the same shape on the same device
+def balance_weights(target, scheme='linear', param=None):
+    if scheme not in SCHEMES:
+        raise ValueError('unknown weighting scheme ' + str(scheme))
+    if scheme == 'none':
+        return torch.full_like(target, 255. if param is None else param)
+    dims = tuple(range(1, target.dim()))
+    shape = (-1,) + (1,) * (target.dim() - 1)
+    pos = (target > 0).sum(dims).type_as(target)
+    neg = target[0].numel() - pos
+    uniform = ((pos == 0) | (pos == neg)).view(shape)
+    b = (torch.min(pos, neg) / (neg - pos).abs().clamp(min=1)).view(shape)
+    if scheme == 'linear':
+        weight = (target + b) * 100
+        flat = 1.
+    elif scheme == 'sqrt':
+        weight = torch.sqrt((target + b) / (1 + b) * 255)
+        flat = 255.
+    elif scheme == 'sqrtb':
+        weight = (target + b.sqrt()) / (1 + b.sqrt()) * 255
+        flat = 255.
+    else:
+        weight = ((target + b) / (1 + b) * 255).clamp(min=20. if param is None else param)
+        flat = 255.
+    return torch.where(uniform, torch.full_like(weight, flat), weight)
+
+
+# BCEWithLogitsLoss whose per-pixel weights come from the target itself; one instance serves a whole training run.
+# A precomputed weight map can be passed to forward() instead, in which case the scheme is not applied.
+class WeightedBCELoss(torch.nn.Module):
+    def __init__(self, scheme='linear', param=None):
+        super(WeightedBCELoss, self).__init__()
+        if scheme not in SCHEMES:
+            raise ValueError('unknown weighting scheme ' + str(scheme))
+        self.scheme = scheme
+        self.param = param
+
+    def forward(self, input, target, weight=None):
+        if weight is None:
+            with torch.no_grad():
+                weight = balance_weights(target, self.scheme, self.param)
+        return F.binary_cross_entropy_with_logits(input, target, weight=weight)
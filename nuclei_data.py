@@ -0,0 +1,105 @@
+import torch
+import torch.utils.data
+from dihedral import DEFAULT_TRANSFORMS, IDENTITY, dihedral, original
+from tensor_store import read_image, read_label
+from tiling import tiles
+
+# torch.utils.data pipeline for the UNet training scripts. One dataset item is one (image, augmentation) pair, already
+# cut into 256x256 tiles, with its label tiles. Decoding, augmentation and tiling all run inside DataLoader worker
+# processes, so the training loop only has to move ready tensors to the device (loss weights come from the tensor
+# store's cache when available, otherwise they are computed there, see losses.py).
+
+
+# handles is the samples.csv DataFrame (Image, Label, Width, Height, ID); mode is 'train', 'val' or 'test'.
+# samples, if given, is the dict returned by dataloader() for the same handles; images are then read from the
+# memory-mapped store instead of being decoded from PNG, together with its cached loss weights if it has any.
+class NucleiDataset(torch.utils.data.Dataset):
+    def __init__(self, handles, mode='train', samples=None, transforms=None, tile=256):
+        self.handles = handles.reset_index(drop=True)
+        self.mode = mode
+        self.samples = samples
+        if transforms is None:
+            transforms = DEFAULT_TRANSFORMS if mode == 'train' else (IDENTITY,)
+        self.transforms = tuple(transforms)
+        self.tile = tile
+
+    def __len__(self):
+        return len(self.handles) * len(self.transforms)
+
+    # un-augmented (C, H, W) image, label and cached loss weights of one row (None where not available)
+    def load(self, row):
+        if self.samples is not None:
+            la = we = None
+            if self.mode != 'test':
+                la = original(self.samples['Label'])[row][0]
+            if 'Weight' in self.samples:
+                we = original(self.samples['Weight'])[row][0]
+            return original(self.samples['Image'])[row][0], la, we
+        im = read_image(self.handles['Image'][row])
+        la = read_label(self.handles['Label'][row]) if self.mode != 'test' else None
+        return im, la, None
+
+    def __getitem__(self, idx):
+        row, k = divmod(idx, len(self.transforms))
+        im, la, we = self.load(row)
+        item = {'index': row}
+        item['image'] = torch.from_numpy(tiles(dihedral(im, self.transforms[k]), self.tile))
+        if la is not None:
+            la = tiles(dihedral(la, self.transforms[k]), self.tile)
+            item['label'] = torch.from_numpy((la / 255).astype('float32'))
+        if we is not None:
+            item['weight'] = torch.from_numpy(tiles(dihedral(we, self.transforms[k]), self.tile))
+        return item
+
+
+# Images have different numbers of tiles, so a batch concatenates tiles along the first axis and records how many
+# tiles came from each image in 'counts'
+def collate_tiles(items):
+    batch = {'index': torch.tensor([it['index'] for it in items]),
+             'counts': torch.tensor([it['image'].shape[0] for it in items])}
+    for key in ('image', 'label', 'weight'):
+        if key in items[0]:
+            batch[key] = torch.cat([it[key] for it in items])
+    return batch
+
+
+# DataLoader with worker processes, pinned host memory (when a GPU is present) and prefetching.
+# batch_size counts images (augmentations), not tiles.
+def make_loader(dataset, batch_size=1, workers=4, shuffle=False, prefetch=2):
+    options = {}
+    if workers > 0:
+        options['prefetch_factor'] = prefetch
+        options['persistent_workers'] = True
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=workers,
+                                       collate_fn=collate_tiles, pin_memory=torch.cuda.is_available(), **options)
+
+
+# Move every tensor of a collated batch to the GPU; pinned memory lets the copies run asynchronously
+def to_device(batch, use_cuda=True):
+    if not use_cuda:
+        return batch
+    return dict((key, value.cuda(non_blocking=True)) for key, value in batch.items())
+
+
+# Regroup the per-image batches of a loader into batches of exactly batch_size tiles (the last one may be smaller),
+# so training can stack tiles of consecutive images into one N x 3 x 256 x 256 forward pass
+def tile_batches(loader, batch_size):
+    buffer = None
+    for batch in loader:
+        items = dict((key, batch[key]) for key in ('image', 'label', 'weight') if key in batch)
+        if buffer is None:
+            buffer = items
+        else:
+            buffer = dict((key, torch.cat([buffer[key], items[key]])) for key in items)
+        while buffer['image'].shape[0] >= batch_size:
+            yield pin(dict((key, value[:batch_size]) for key, value in buffer.items()))
+            buffer = dict((key, value[batch_size:]) for key, value in buffer.items())
+    if buffer is not None and buffer['image'].shape[0] > 0:
+        yield pin(buffer)
+
+
+# Regrouped batches are fresh tensors; pin them again so to_device can still copy asynchronously
+def pin(batch):
+    if not torch.cuda.is_available():
+        return batch
+    return dict((key, value.pin_memory()) for key, value in batch.items())
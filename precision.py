@@ -0,0 +1,43 @@
+import torch
+
+# Reduced-precision execution for the UNet scripts. Model weights, optimizer state and losses stay float32; only the
+# forward pass runs under torch.autocast, so convolutions (which dominate runtime) read and write half-width tensors.
+#   'fp32'  plain float32, no autocast
+#   'bf16'  bfloat16 autocast; works on CPU and GPU and keeps float32's exponent range, so no loss scaling is needed
+#   'fp16'  float16 autocast with dynamic loss scaling (GradScaler); GPU only
+
+PRECISIONS = ('fp32', 'bf16', 'fp16')
+
+
+class NoAutocast(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+def check_precision(precision, device_type):
+    if precision not in PRECISIONS:
+        raise ValueError('unknown precision ' + str(precision))
+    if precision == 'fp16' and device_type != 'cuda':
+        raise ValueError('fp16 autocast needs a GPU; use bf16 on CPU')
+
+
+# Context manager running the forward pass of a model on device_type ('cpu' or 'cuda') at the given precision
+def autocast(precision, device_type):
+    check_precision(precision, device_type)
+    if precision == 'fp32':
+        return NoAutocast()
+    dtype = torch.bfloat16 if precision == 'bf16' else torch.float16
+    return torch.autocast(device_type, dtype=dtype)
+
+
+# Loss scaler for the training loop: only float16 gradients can underflow, every other precision gets a disabled
+# scaler whose scale()/step()/update() are plain pass-throughs
+def make_scaler(precision, device_type):
+    check_precision(precision, device_type)
+    enabled = precision == 'fp16'
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device_type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
@@ -0,0 +1,121 @@
+import sys
+import copy
+import time
+import numpy as np  # linear algebra
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from deploy import load_checkpoint, freeze_unet
+from evaluate import tile_metric
+
+# Post-training static INT8 quantization of a trained unet.UNet for CPU inference. The model is traced with torch.fx,
+# every convolution is fused with its BatchNorm and ReLU, observers record activation ranges over calibration tiles
+# from the validation split, and the result runs quantized convolutions (fbgemm/oneDNN on x86, qnnpack on ARM) with
+# per-channel int8 weights. Weight-only dynamic quantization is not offered: it only covers Linear and recurrent
+# layers, and this model is all convolutions.
+# Usage: python quantize.py <checkpoint, e.g. ../out1/unet-30> <artifact> [calibration images] [evaluation images]
+#                           [backend]
+# Calibrates on a random subset of vsamples.csv, saves the quantized model as frozen TorchScript (run_inference.py
+# loads it like any other artifact) and reports metric() and CPU latency of the float and quantized models on the
+# remaining validation images (all of them by default).
+
+BACKENDS = ('x86', 'fbgemm', 'onednn', 'qnnpack')
+INPUTS = '../inputs/'
+CALIBRATION_IMAGES = 32
+TILE = 256
+BATCH = 4
+
+
+# Quantized copy of a UNet; calibration is an iterable of (N, 3, H, W) float32 tensors as they are fed at inference
+def quantize_unet(model, calibration, backend='x86'):
+    if backend not in BACKENDS:
+        raise ValueError('unknown quantization backend ' + str(backend))
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).eval()
+    model.checkpoint = False
+    prepared = None
+    with torch.no_grad():
+        for batch in calibration:
+            if prepared is None:
+                prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (batch,))
+            prepared(batch)
+    if prepared is None:
+        raise ValueError('no calibration batches')
+    return convert_fx(prepared)
+
+
+# Save a quantized UNet as frozen TorchScript; like deploy.freeze_unet, it accepts other sizes that are multiples of 64
+def export_quantized(quantized, path, tile=TILE):
+    with torch.no_grad():
+        frozen = torch.jit.freeze(torch.jit.trace(quantized, torch.rand(1, 3, tile, tile)))
+    torch.jit.save(frozen, path)
+    return frozen
+
+
+# Batches of at most batch tiles from dataset items (nuclei_data.NucleiDataset), as (images, labels or None)
+def item_batches(items, batch=BATCH):
+    for item in items:
+        for start in range(0, item['image'].shape[0], batch):
+            label = item.get('label')
+            yield item['image'][start:start + batch], None if label is None else label[start:start + batch]
+
+
+# metric() and seconds per tile of each named model on the given (images, labels) batches; the first model is the
+# reference for the agreement of thresholded masks. Returns a list of (name, metric, seconds per tile, agreement).
+def compare(models, batches):
+    scores = [[] for _ in models]
+    agree = [[] for _ in models]
+    seconds = [0.] * len(models)
+    tiles = 0
+    with torch.no_grad():
+        for images, labels in batches:
+            reference = None
+            for i, (name, model) in enumerate(models):
+                start = time.time()
+                prob = torch.sigmoid(model(images))
+                seconds[i] += time.time() - start
+                scores[i].append(tile_metric(prob, labels))
+                if reference is None:
+                    reference = prob > 0.5
+                agree[i].append(((prob > 0.5) == reference).float().reshape(prob.shape[0], -1).mean(1))
+            tiles += images.shape[0]
+    return [(name, torch.cat(scores[i]).mean().item(), seconds[i] / tiles, torch.cat(agree[i]).mean().item())
+            for i, (name, model) in enumerate(models)]
+
+
+def print_report(report):
+    print('{:<10} {:>10} {:>10} {:>10} {:>12}'.format('', 'metric', 'ms/tile', 'speedup', 'agree fp32'))
+    for name, score, seconds, agree in report:
+        print('{:<10} {:>10.4f} {:>10.1f} {:>9.2f}x {:>12.4f}'.format(name, score, seconds * 1000,
+                                                                       report[0][2] / seconds, agree))
+
+
+# Validation images of vsamples.csv in the tensor store (as RH_seg.py builds it), split at random into a calibration
+# subset and the evaluation images
+def validation_split(calibration=CALIBRATION_IMAGES, evaluation=None, seed=1234):
+    import pandas as pd
+    from tensor_store import load_store
+    from nuclei_data import NucleiDataset
+    va = pd.read_csv(INPUTS + 'stage_1_test/vsamples.csv', header=0,
+                     usecols=['Image', 'Label', 'Width', 'Height', 'ID'])
+    dataset = NucleiDataset(va, 'val', load_store(va, 'val', INPUTS + 'cropped/'), tile=TILE)
+    rows = np.random.RandomState(seed).permutation(len(dataset))
+    evaluate_rows = rows[calibration:] if evaluation is None else rows[calibration:calibration + evaluation]
+    return (dataset[i] for i in rows[:calibration]), (dataset[i] for i in evaluate_rows)
+
+
+if __name__ == '__main__':
+    checkpoint_path = sys.argv[1]
+    artifact = sys.argv[2]
+    n_calibration = int(sys.argv[3]) if len(sys.argv) > 3 else CALIBRATION_IMAGES
+    n_evaluation = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    quant_backend = sys.argv[5] if len(sys.argv) > 5 else 'x86'
+    unet = load_checkpoint(checkpoint_path)
+    calibration_items, evaluation_items = validation_split(n_calibration, n_evaluation)
+    start = time.time()
+    int8 = quantize_unet(unet, (images for images, labels in item_batches(calibration_items)), quant_backend)
+    print('Calibrated on {} validation images in {:.1f} s'.format(n_calibration, time.time() - start))
+    int8 = export_quantized(int8, artifact)
+    print('Saved the quantized model to ' + artifact)
+    fp32 = freeze_unet(unet, torch.rand(1, 3, TILE, TILE))
+    print_report(compare([('eager', unet), ('frozen', fp32), ('int8', int8)], item_batches(evaluation_items)))
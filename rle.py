@@ -0,0 +1,55 @@
+import numpy as np  # linear algebra
+
+# Run-length encoding for the contest csv. Pixels are numbered top to bottom, then left to right (column-major), from 1,
+# and a mask is written as "start length start length ...". The scripts used to loop in Python over every foreground
+# pixel and compare the whole labelled image against each nucleus label in turn; here all runs of a labelled image
+# are found in one pass over its column-major flattening and then grouped by label.
+
+
+# Runs of every label of a labelled image (0 is background); returns a list whose entry i - 1 holds the
+# [start, length, ...] list of label i, for i = 1 .. lab_img.max()
+def label_rles(lab_img):
+    flat = np.asarray(lab_img).T.ravel()
+    n_labels = int(flat.max()) if flat.size else 0
+    if n_labels <= 0:
+        return []
+    # a run starts wherever the label differs from the previous pixel
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.append(starts, flat.size))
+    values = flat[starts]
+    keep = values > 0
+    starts, lengths, values = starts[keep], lengths[keep], values[keep]
+    # group by label; the stable sort keeps each label's runs in pixel order
+    order = np.argsort(values, kind='stable')
+    pairs = np.stack((starts[order] + 1, lengths[order]), axis=1)
+    counts = np.bincount(values[order].astype('int64'), minlength=n_labels + 1)[1:]
+    return [runs.ravel().tolist() for runs in np.split(pairs, np.cumsum(counts)[:-1])]
+
+
+# For contest csv conversion only: runs of one binary mask
+def rle_encoding(x):
+    runs = label_rles(np.asarray(x) == 1)
+    return runs[0] if runs else []
+
+
+# For contest csv conversion only: runs of every connected nucleus of a probability map
+def prob_to_rles(x, cutoff=0.5):
+    from skimage.morphology import label
+    for runs in label_rles(label(x > cutoff)):
+        yield runs
+
+
+# Inverse of label_rles: (H, W) int32 labelled image of the given shape in which the pixels of rles[i] (a
+# [start, length, ...] list) are labelled i + 1
+def rles_to_labels(rles, shape):
+    flat = np.zeros(shape[0] * shape[1], dtype='int32')
+    runs = [np.asarray(r, dtype='int64').reshape(-1, 2) for r in rles]
+    if runs:
+        ids = np.repeat(np.arange(1, len(runs) + 1), [len(r) for r in runs])
+        runs = np.concatenate(runs)
+        lengths = runs[:, 1]
+        # every pixel of every run: its run's start plus its position inside the run
+        ends = np.cumsum(lengths)
+        pixels = np.repeat(runs[:, 0] - 1 - (ends - lengths), lengths) + np.arange(ends[-1] if len(ends) else 0)
+        flat[pixels] = np.repeat(ids, lengths)
+    return flat.reshape(shape[1], shape[0]).T
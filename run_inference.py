@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import torch
+from tensor_store import read_image
+from inference import predict_images
+from rle import prob_to_rles
+from submission import SubmissionWriter
+
+# Standalone prediction for a directory of PNGs with a model exported by deploy.py, without the training scripts.
+# Images are read and normalized like the tensor store does, predicted with overlapping tiles (inference.py),
+# thresholded, split into connected nuclei and run-length encoded into a contest csv (ImageId, EncodedPixels; a .gz
+# output path is compressed).
+# Only numpy, torch and imageio are imported at startup; pandas and matplotlib are never needed, and skimage is only
+# loaded for labelling nuclei once the first mask is ready.
+# Images should have been preprocessed like the training inputs (munging_mirror.py); mirror padding is not needed.
+# Usage: python run_inference.py <model> <image directory> <output csv> [threshold] [tile] [overlap] [batch]
+#   model is a TorchScript (.pt) or ONNX (.onnx, needs onnxruntime) artifact from deploy.py or quantize.py, or a
+#   training checkpoint
+#   the image directory holds <id>.png files, or <id>/images/<id>.png folders as in the contest data
+
+TILE = 256
+OVERLAP = 64
+TEST_BATCH = 8
+THRESHOLD = 0.5
+
+
+# Runs an onnxruntime session like a torch module, so predict_images can drive it
+class OnnxModel(torch.nn.Module):
+    def __init__(self, path):
+        super(OnnxModel, self).__init__()
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+
+    def forward(self, x):
+        return torch.from_numpy(self.session.run(None, {'image': x.numpy()})[0])
+
+
+# Model from an exported artifact or, failing that, from a training checkpoint (which needs unet.py)
+def load_model(path):
+    if path.endswith('.onnx'):
+        return OnnxModel(path)
+    try:
+        return torch.jit.load(path, map_location='cpu')
+    except RuntimeError:
+        from deploy import load_checkpoint
+        return load_checkpoint(path)
+
+
+# (ID, path) of every image of a directory, sorted by ID
+def find_images(directory):
+    images = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith('.png') and os.path.isfile(path):
+            images.append((name[:-len('.png')], path))
+        elif os.path.isfile(os.path.join(path, 'images', name + '.png')):
+            images.append((name, os.path.join(path, 'images', name + '.png')))
+    return images
+
+
+def run(model_path, directory, output, threshold=THRESHOLD, tile=TILE, overlap=OVERLAP, batch_size=TEST_BATCH):
+    start = time.time()
+    model = load_model(model_path)
+    images = find_images(directory)
+    ims = (read_image(path) for imid, path in images)
+    with SubmissionWriter(output) as sub:
+        for itr, prob in predict_images(model, ims, tile, overlap, 'cosine', batch_size):
+            sub.write(images[itr][0], prob_to_rles(prob, threshold))
+    print('Predicted {} nuclei in {} images in {:.1f} s'.format(sub.nuclei, sub.images, time.time() - start))
+
+
+if __name__ == '__main__':
+    run(sys.argv[1], sys.argv[2], sys.argv[3],
+        float(sys.argv[4]) if len(sys.argv) > 4 else THRESHOLD,
+        int(sys.argv[5]) if len(sys.argv) > 5 else TILE,
+        int(sys.argv[6]) if len(sys.argv) > 6 else OVERLAP,
+        int(sys.argv[7]) if len(sys.argv) > 7 else TEST_BATCH)
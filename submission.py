@@ -0,0 +1,81 @@
+import io
+import os
+import sys
+import csv
+import gzip
+import tempfile
+
+# Contest submission csv (ImageId, EncodedPixels) written one image at a time. test() used to collect every run list of
+# the whole test set in Python lists and join them into strings through a DataFrame at the end; here each image's rows
+# are formatted and written as soon as its mask is ready, so memory stays flat and everything written before an
+# interruption is already on disk. An image without any detected nucleus still gets a row, with empty EncodedPixels.
+# Paths ending in .gz (or compress=True) are gzip-compressed, one complete gzip member per flush: concatenated members
+# are a valid gzip file, so a file that was never closed still decompresses up to the last flush (a single gzip stream
+# would only get its end-of-stream marker on close). Fewer, larger members compress better (flush_every).
+# Usage: python submission.py [images] [flush_every]
+#   checks that an unclosed .gz submission reads back with evaluate.read_submission
+
+
+class SubmissionWriter(object):
+    # flush_every: images between flushes of the file buffer to disk
+    def __init__(self, path, compress=None, flush_every=1):
+        if compress is None:
+            compress = path.endswith('.gz')
+        self.compress = compress
+        self.file = open(path, 'wb' if compress else 'w')
+        # rows of a compressed file wait here until the next flush turns them into a gzip member
+        self.buffer = io.StringIO() if compress else None
+        self.writer = csv.writer(self.buffer if compress else self.file, lineterminator='\n')
+        self.writer.writerow(['ImageId', 'EncodedPixels'])
+        self.flush_every = flush_every
+        self.images = 0
+        self.nuclei = 0
+
+    # Write the rows of one image; rles is an iterable of [start, length, ...] run lists (e.g. rle.prob_to_rles)
+    def write(self, imid, rles):
+        rows = [(imid, ' '.join(map(str, runs))) for runs in rles]
+        self.writer.writerows(rows or [(imid, '')])
+        self.images += 1
+        self.nuclei += len(rows)
+        if self.images % self.flush_every == 0:
+            self.flush()
+
+    # Hand everything written so far to the operating system
+    def flush(self):
+        if self.compress:
+            rows = self.buffer.getvalue()
+            if rows:
+                self.file.write(gzip.compress(rows.encode('utf-8')))
+                self.buffer.seek(0)
+                self.buffer.truncate()
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+
+if __name__ == '__main__':
+    from evaluate import read_submission
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    every = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    expected = dict(('image{}'.format(i), [[1 + 10 * j, 3 + i] for j in range(i)]) for i in range(n_images))
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'unclosed.csv.gz')
+    # written like an interrupted run: flushed every flush_every images but never closed
+    unclosed = SubmissionWriter(path, flush_every=every)
+    for image_id in sorted(expected):
+        unclosed.write(image_id, expected[image_id])
+    read = read_submission(path)
+    flushed = sorted(expected)[:n_images // every * every]
+    print('Read {} of {} images from an unclosed submission ({} flushed, {} bytes); rows {}'.format(
+        len(read), n_images, len(flushed), os.path.getsize(path),
+        'match' if read == dict((image_id, expected[image_id]) for image_id in flushed) else 'DIFFER'))
@@ -0,0 +1,175 @@
+import os
+import glob
+import numpy as np  # linear algebra
+import torch
+from imageio import imread
+from dihedral import DihedralSamples, original
+from losses import balance_weights
+
+# Memory-mapped replacement for the whole-dataset pickle cache used by dataloader() in the training scripts.
+# Each split (train/val/test) is written once to raw buffers on disk:
+#   <mode>_images.raw  float32 images, (1, 3, H, W) per sample, back to back
+#   <mode>_labels.raw  uint8 labels, (1, 1, H, W) per sample, back to back (train/val only)
+#   <mode>_index.npz   offsets/shapes into the raw buffers plus IDs and original dimensions
+#   <mode>_weights_<scheme>_<param>_<tile>.raw
+#                      float32 loss weight maps, laid out like the labels; one file per weighting (train/val only)
+# Loading opens the raw buffers with np.memmap, so only the samples a training loop touches get paged in.
+# Only originals are stored; training augmentations are produced at access time as views (see dihedral.py).
+
+STORE_VERSION = 2
+
+
+# Lazy list-like view over one raw buffer; item i is a read-only (1, C, H, W) array backed by the memmap
+class MappedArrays(object):
+    def __init__(self, path, dtype, offsets, shapes):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.offsets = offsets
+        self.shapes = shapes
+        self.buffer = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        if self.buffer is None:
+            self.buffer = np.memmap(self.path, dtype=self.dtype, mode='r')
+        shape = tuple(self.shapes[idx])
+        start = self.offsets[idx]
+        return self.buffer[start:start + int(np.prod(shape))].reshape(shape)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    # memmaps do not survive pickling to DataLoader workers; each process re-opens the file on first access
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['buffer'] = None
+        return state
+
+
+# Read one image the same way the pickle dataloader did: normalize to 0-255 and move channels first
+def read_image(path):
+    im = imread(path)
+    im = im / im.max() * 255
+    return np.ascontiguousarray(np.transpose(im[:, :, :3], (2, 0, 1)), dtype='float32')
+
+
+# Read one label mask as a (1, H, W) uint8 array
+def read_label(path):
+    la = imread(path)
+    return np.ascontiguousarray(np.reshape(la, [1, la.shape[0], la.shape[1]]), dtype='uint8')
+
+
+def store_paths(directory, mode):
+    prefix = os.path.join(directory, mode)
+    return prefix + '_images.raw', prefix + '_labels.raw', prefix + '_index.npz'
+
+
+# Write a split to disk one sample at a time, so building the store never holds the whole dataset in memory.
+# The index is written last; a build that dies half way has no index and is simply redone on the next run.
+def build_store(handles, mode, directory):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    im_path, la_path, index_path = store_paths(directory, mode)
+    # cached weight maps belong to the labels being replaced
+    for path in glob.glob(os.path.join(directory, mode + '_weights_*.raw')):
+        os.remove(path)
+    im_offsets, im_shapes, la_offsets, la_shapes, ids, dims = [], [], [], [], [], []
+    im_pos = la_pos = 0
+    with open(im_path, 'wb') as im_f, open(la_path, 'wb') as la_f:
+        for idx, row in handles.iterrows():
+            im = read_image(row['Image'])[None]
+            im_f.write(im.tobytes())
+            im_offsets.append(im_pos)
+            im_shapes.append(im.shape)
+            im_pos += im.size
+            if mode != 'test':
+                la = read_label(row['Label'])[None]
+                la_f.write(la.tobytes())
+                la_offsets.append(la_pos)
+                la_shapes.append(la.shape)
+                la_pos += la.size
+            else:
+                dims.append((row['Width'], row['Height']))
+            ids.append(row['ID'])
+    np.savez(index_path, version=STORE_VERSION,
+             im_offsets=np.array(im_offsets, dtype='int64'), im_shapes=np.array(im_shapes, dtype='int64'),
+             la_offsets=np.array(la_offsets, dtype='int64'), la_shapes=np.array(la_shapes, dtype='int64').reshape(-1, 4),
+             ids=np.array(ids, dtype=str), dims=np.array(dims, dtype='int64').reshape(-1, 2))
+
+
+# Open a split written by build_store; returns the same dict layout the pickle dataloader produced.
+# Training images and labels come back as DihedralSamples, so sample['Image'][i][k] is the k-th augmentation.
+def open_store(mode, directory):
+    im_path, la_path, index_path = store_paths(directory, mode)
+    index = np.load(index_path)
+    if int(index['version']) != STORE_VERSION:
+        raise IOError('tensor store ' + index_path + ' has an outdated format')
+    images = {}
+    images['Image'] = MappedArrays(im_path, 'float32', index['im_offsets'], index['im_shapes'])
+    images['Label'] = MappedArrays(la_path, 'uint8', index['la_offsets'], index['la_shapes'])
+    images['ID'] = [str(i) for i in index['ids']]
+    images['Dim'] = [[(int(w), int(h))] for w, h in index['dims']]
+    if mode == 'train':
+        images['Image'] = DihedralSamples(images['Image'])
+        images['Label'] = DihedralSamples(images['Label'])
+    return images
+
+
+def weight_path(directory, mode, scheme, param, tile):
+    return os.path.join(directory, '{}_weights_{}_{}_{}.raw'.format(mode, scheme, param, tile))
+
+
+# Loss weights of one (1, 1, H, W) uint8 label. With tile set, weights are computed per tile x tile block, exactly as
+# the tiled training loops see them (leftover rows/columns keep weight 1); otherwise over the whole label.
+def label_weights(la, scheme, param=None, tile=None):
+    t = torch.from_numpy(la.astype('float32') / 255)
+    if tile is None:
+        return balance_weights(t, scheme, param).numpy()
+    weight = torch.ones_like(t)
+    num1, num2 = t.shape[-2] // tile, t.shape[-1] // tile
+    blocks = t[0, 0, :num1 * tile, :num2 * tile].reshape(num1, tile, num2, tile).permute(0, 2, 1, 3)
+    blocks = balance_weights(blocks.reshape(-1, 1, tile, tile), scheme, param)
+    weight[0, 0, :num1 * tile, :num2 * tile] = blocks.reshape(num1, num2, tile, tile).permute(0, 2, 1, 3).reshape(
+        num1 * tile, num2 * tile)
+    return weight.numpy()
+
+
+# Compute the weight maps of a split once and store them next to its labels. Weights depend only on the label, and
+# rotating/flipping a label rotates/flips its weights (tile grids of padded images line up), so training augmentations
+# reuse the same maps as views instead of recomputing them every epoch.
+def build_weights(mode, directory, scheme, param=None, tile=None):
+    path = weight_path(directory, mode, scheme, param, tile)
+    labels = original(open_store(mode, directory)['Label'])
+    with open(path + '.tmp', 'wb') as f:
+        for la in labels:
+            f.write(label_weights(np.asarray(la), scheme, param, tile).tobytes())
+    os.rename(path + '.tmp', path)
+
+
+# Attach the cached weight maps for (scheme, param, tile) to a dict returned by open_store, building them if needed;
+# images['Weight'][i] is indexed exactly like images['Label'][i]
+def load_weights(images, mode, directory, scheme, param=None, tile=None):
+    path = weight_path(directory, mode, scheme, param, tile)
+    if not os.path.exists(path):
+        build_weights(mode, directory, scheme, param, tile)
+    labels = original(images['Label'])
+    images['Weight'] = MappedArrays(path, 'float32', labels.offsets, labels.shapes)
+    if mode == 'train':
+        images['Weight'] = DihedralSamples(images['Weight'], images['Label'].transforms)
+    return images
+
+
+# Drop-in for the scripts' dataloader(handles, mode): open the store if it exists, otherwise build it first.
+# With a weighting scheme, the cached loss weight maps of train/val splits are attached as images['Weight'].
+def load_store(handles, mode, directory, scheme=None, param=None, tile=None):
+    try:
+        images = open_store(mode, directory)
+    except (IOError, OSError, KeyError):
+        build_store(handles, mode, directory)
+        images = open_store(mode, directory)
+    if scheme is not None and mode != 'test':
+        load_weights(images, mode, directory, scheme, param, tile)
+    return images
@@ -0,0 +1,39 @@
+import numpy as np  # linear algebra
+from numpy.lib.stride_tricks import as_strided
+
+# Square tiles of the last two (H, W) axes of an array without Python loops. The scripts' minicut() sliced tile by tile
+# into a list and np.array() copied the list; here tile_view() is a strided view of every whole tile at once (no pixel
+# is copied, and it works on dihedral.py's flipped/rotated views too), tiles() flattens it into an (N, ..., tile, tile)
+# batch in row-major tile order, and untile() writes such a batch back into an image through the same view.
+# Rows and columns left over past the last whole tile are ignored, as minicut did.
+
+
+# (rows, cols, ..., tile, tile) view of the whole tiles of an (..., H, W) array; tile_view(im)[r, c] is the tile at
+# row r, column c. Writing through the view writes into im.
+def tile_view(im, tile=256):
+    rows, cols = im.shape[-2] // tile, im.shape[-1] // tile
+    row_stride, col_stride = im.strides[-2:]
+    return as_strided(im, shape=(rows, cols) + im.shape[:-2] + (tile, tile),
+                      strides=(row_stride * tile, col_stride * tile) + im.strides[:-2] + (row_stride, col_stride),
+                      writeable=im.flags.writeable)
+
+
+# (N, ..., tile, tile) tiles of an (..., H, W) array, N = rows * cols in row-major order, gathered from tile_view() in
+# one vectorized copy into a new contiguous array (a batch axis cannot stride over a 2D grid of tiles, so this is the
+# one copy a training batch needs; use tile_view() to read tiles in place)
+def tiles(im, tile=256):
+    view = tile_view(im, tile)
+    batch = np.empty((view.shape[0] * view.shape[1],) + view.shape[2:], dtype=im.dtype)
+    batch.reshape(view.shape)[...] = view
+    return batch
+
+
+# Inverse of tiles(): write (rows * cols, ..., tile, tile) tiles back into an (..., rows * tile, cols * tile) array.
+# out, if given, is written in place (its region past the whole tiles is left untouched); the tiles are broadcast
+# against it, e.g. 1-channel predictions into a 3-channel buffer.
+def untile(batch, rows, cols, out=None):
+    tile = batch.shape[-1]
+    if out is None:
+        out = np.empty(batch.shape[1:-2] + (rows * tile, cols * tile), dtype=batch.dtype)
+    tile_view(out, tile)[:rows, :cols] = batch.reshape((rows, cols) + batch.shape[1:])
+    return out
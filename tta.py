@@ -0,0 +1,84 @@
+import time
+import torch
+from torch.nn import functional as F
+from dihedral import IDENTITY, ROT90, ROT270, FLIPLR, FLIPUD, TRANSPOSE, ANTITRANSPOSE, N_DIHEDRAL, inverse
+from inference import model_device
+from precision import autocast
+
+# Test-time augmentation over the dihedral transforms of dihedral.py, for inference.predict_images. Every requested
+# orientation of a batch of tiles is stacked into one forward pass on the model's device; the predictions are turned
+# back to the original orientation and their probabilities averaged there, so only the averaged map goes back to the
+# host. A batch of n tiles becomes a forward pass of n * len(transforms) tiles, so lower predict_images' batch_size
+# accordingly.
+# With a threshold, the first transform is predicted for every tile and the others only for tiles whose mean
+# uncertainty 1 - |2p - 1| (0 for confident pixels, 1 at p = 0.5) exceeds it.
+
+ALL_TRANSFORMS = tuple(range(N_DIHEDRAL))
+
+
+# Dihedral transform k of the last two axes of a tensor, the torch counterpart of dihedral.dihedral (tiles are square,
+# so every transform keeps the shape)
+def transform(x, k):
+    if k == IDENTITY:
+        return x
+    elif ROT90 <= k <= ROT270:
+        return torch.rot90(x, k, dims=(-2, -1))
+    elif k == FLIPLR:
+        return torch.flip(x, dims=(-1,))
+    elif k == FLIPUD:
+        return torch.flip(x, dims=(-2,))
+    elif k == TRANSPOSE:
+        return x.transpose(-2, -1)
+    elif k == ANTITRANSPOSE:
+        return torch.flip(x.transpose(-2, -1), dims=(-2, -1))
+    raise ValueError('unknown dihedral transform {}'.format(k))
+
+
+# Per-tile mean uncertainty of (N, C, H, W) probabilities
+def uncertainty(prob):
+    return (1 - (2 * prob - 1).abs()).reshape(prob.shape[0], -1).mean(1)
+
+
+# Predict function for inference.predict_images averaging the given dihedral transforms. Counts the tiles it has seen,
+# the extra oriented tiles it predicted and the seconds it spent, for reporting.
+class DihedralTTA(object):
+    def __init__(self, transforms=ALL_TRANSFORMS, threshold=None):
+        self.transforms = tuple(transforms)
+        if not self.transforms:
+            raise ValueError('no transforms')
+        self.threshold = threshold
+        self.tiles = 0
+        self.extra = 0
+        self.seconds = 0.
+
+    # Sum of the probabilities of transforms ks of x, in x's orientation
+    def summed(self, run, x, ks):
+        logits = run(torch.cat([transform(x, k) for k in ks])).float()
+        prob = 0
+        for k, part in zip(ks, logits.split(x.shape[0])):
+            prob = prob + transform(F.sigmoid(part), inverse(k))
+        return prob
+
+    def __call__(self, model, batch, precision='fp32'):
+        start = time.time()
+        device = model_device(model)
+        run = getattr(model, 'predict', model)
+        with torch.no_grad(), autocast(precision, device.type):
+            x = torch.from_numpy(batch).to(device)
+            if self.threshold is None:
+                prob = self.summed(run, x, self.transforms) / len(self.transforms)
+                self.extra += x.shape[0] * (len(self.transforms) - 1)
+            else:
+                prob = self.summed(run, x, self.transforms[:1])
+                pick = (uncertainty(prob) > self.threshold).nonzero()[:, 0]
+                if len(pick) and len(self.transforms) > 1:
+                    prob[pick] = (prob[pick] + self.summed(run, x[pick], self.transforms[1:])) / len(self.transforms)
+                    self.extra += len(pick) * (len(self.transforms) - 1)
+        prob = prob.cpu().numpy()
+        self.tiles += batch.shape[0]
+        self.seconds += time.time() - start
+        return prob
+
+    # Share of the extra oriented tiles actually predicted, out of len(transforms) - 1 per tile
+    def coverage(self):
+        return self.extra / float(max(1, self.tiles * (len(self.transforms) - 1)))
@@ -0,0 +1,127 @@
+import torch
+import torch.utils.checkpoint
+
+# The UNet shared by RH_seg.py and the whole-image training scripts, by default: seven down-sampling blocks from 16 to
+# 1024 channels, three 1024-channel middle convolutions and six up-sampling blocks back to 16, each block being three
+# 3x3 convolution + BatchNorm + ReLU layers.
+# Inputs must then have sides that are multiples of 64 (six 2x2 max-pools). Skip connections live only for the duration
+# of a forward pass, and each block can optionally be checkpointed (python benchmark.py memory reports the savings).
+# Depth, base width, convolutions per block and the upsampling mode are parameters of UNet; python benchmark.py family
+# compares variants with the original configuration.
+
+UPSAMPLE_MODES = ('bilinear', 'nearest', 'transpose')
+
+## Main U-net model
+# Down sampling phase layers: an optional 2x2 max-pool, then convs 3x3 convolution + BatchNorm + ReLU layers
+# (attributes conv1/bn1 ... conv<convs>/bn<convs>)
+class UNet_down_block(torch.nn.Module):
+    def __init__(self, input_channel, output_channel, down_size, convs=3):
+        super(UNet_down_block, self).__init__()
+        self.convs = convs
+        for i in range(1, convs + 1):
+            setattr(self, 'conv{}'.format(i), torch.nn.Conv2d(input_channel if i == 1 else output_channel,
+                                                             output_channel, 3, padding=1))
+            setattr(self, 'bn{}'.format(i), torch.nn.BatchNorm2d(output_channel))
+        self.max_pool = torch.nn.MaxPool2d(2, 2)
+        self.relu = torch.nn.ReLU()
+        self.down_size = down_size
+
+    def forward(self, x):
+        if self.down_size:
+            x = self.max_pool(x)
+        for i in range(1, self.convs + 1):
+            x = self.relu(getattr(self, 'bn{}'.format(i))(getattr(self, 'conv{}'.format(i))(x)))
+        return x
+
+# Up sampling phase layers: 2x upsampling of the coarser map (bilinear or nearest interpolation, or a learned
+# 'transpose' convolution), concatenation with the skip connection, then convs convolution + BatchNorm + ReLU layers
+class UNet_up_block(torch.nn.Module):
+    def __init__(self, prev_channel, input_channel, output_channel, convs=3, upsample='bilinear'):
+        super(UNet_up_block, self).__init__()
+        if upsample not in UPSAMPLE_MODES:
+            raise ValueError('unknown upsampling mode ' + str(upsample))
+        if upsample == 'transpose':
+            self.up_sampling = torch.nn.ConvTranspose2d(input_channel, input_channel, 2, stride=2)
+        else:
+            self.up_sampling = torch.nn.Upsample(scale_factor=2, mode=upsample)
+        self.convs = convs
+        for i in range(1, convs + 1):
+            in_channel = prev_channel + input_channel if i == 1 else output_channel
+            setattr(self, 'conv{}'.format(i), torch.nn.Conv2d(in_channel, output_channel, 3, padding=1))
+            setattr(self, 'bn{}'.format(i), torch.nn.BatchNorm2d(output_channel))
+        self.relu = torch.nn.ReLU()
+
+    def forward(self, prev_feature_map, x):
+        x = self.up_sampling(x)
+        x = torch.cat((x, prev_feature_map), dim=1)
+        for i in range(1, self.convs + 1):
+            x = self.relu(getattr(self, 'bn{}'.format(i))(getattr(self, 'conv{}'.format(i))(x)))
+        return x
+
+# Put them together and build the model to use
+# depth down blocks (the first one without pooling) doubling from width channels, convs middle convolutions at the
+# widest level, depth - 1 up blocks back to width channels, and the output convolutions. The defaults are the original
+# architecture, with the same state_dict keys. Inputs must have sides that are multiples of stride = 2 ** (depth - 1).
+# checkpoint=True trades compute for memory: see run_block. It does not change the parameters or state_dict keys.
+class UNet(torch.nn.Module):
+    def __init__(self, checkpoint=False, depth=7, width=16, convs=3, upsample='bilinear'):
+        super(UNet, self).__init__()
+        self.checkpoint = checkpoint
+        self.depth = depth
+        self.convs = convs
+        self.stride = 2 ** (depth - 1)
+        # architecture arguments, saved with checkpoints ('unet') so deploy.load_checkpoint can rebuild the same model
+        self.config = dict(depth=depth, width=width, convs=convs, upsample=upsample)
+        channels = [width * 2 ** i for i in range(depth)]
+
+        for i in range(depth):
+            setattr(self, 'down_block{}'.format(i + 1),
+                    UNet_down_block(channels[i - 1] if i else 3, channels[i], i > 0, convs))
+
+        for i in range(1, convs + 1):
+            setattr(self, 'mid_conv{}'.format(i), torch.nn.Conv2d(channels[-1], channels[-1], 3, padding=1))
+            setattr(self, 'bn{}'.format(i), torch.nn.BatchNorm2d(channels[-1]))
+
+        for i in range(1, depth):
+            setattr(self, 'up_block{}'.format(i),
+                    UNet_up_block(channels[-1 - i], channels[-i], channels[-1 - i], convs, upsample))
+
+        self.last_conv1 = torch.nn.Conv2d(width, width, 3, padding=1)
+        self.last_bn = torch.nn.BatchNorm2d(width)
+        self.last_conv2 = torch.nn.Conv2d(width, 1, 1, padding=0)
+        self.relu = torch.nn.ReLU()
+
+    # Skip tensors are locals, so nothing outlives the call; with checkpointing on, each down/up block keeps only its
+    # input during training and recomputes its inner activations in the backward pass
+    def forward(self, x):
+        block = self.run_block
+        skips = []
+        for i in range(1, self.depth + 1):
+            x = block(getattr(self, 'down_block{}'.format(i)), x)
+            skips.append(x)
+        skips.pop()
+        for i in range(1, self.convs + 1):
+            x = self.relu(getattr(self, 'bn{}'.format(i))(getattr(self, 'mid_conv{}'.format(i))(x)))
+        for i in range(1, self.depth):
+            x = block(getattr(self, 'up_block{}'.format(i)), skips.pop(), x)
+        x = self.relu(self.last_bn(self.last_conv1(x)))
+        x = self.last_conv2(x)
+        return x
+
+    # Run one block, checkpointed if enabled and gradients are being recorded. Recomputed BatchNorm layers update
+    # their running statistics a second time, as with any checkpointed BatchNorm.
+    def run_block(self, module, *inputs):
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(module, *inputs, use_reentrant=False)
+        return module(*inputs)
+
+    # Inference entry point: autograd off and running BatchNorm statistics; returns logits like forward(). The
+    # module's training/eval mode is restored afterwards.
+    def predict(self, x):
+        was_training = self.training
+        self.eval()
+        try:
+            with torch.no_grad():
+                return self.forward(x)
+        finally:
+            self.train(was_training)